@@ -0,0 +1,286 @@
+import math
+import numpy as np
+
+from utils.raycast import cast_rays
+from utils.kinematics import differential_drive_batch
+from utils.collision_detection import get_collisions
+from utils.sensor_model import get_sensor_angles
+from ann import PopulationNetwork
+
+
+# Simulates N agents controlled by ANNs in lockstep.
+# Instead of one Agent/MotionModel/SensorModel object graph per agent, the
+# state of all the agents is kept in NumPy arrays (one entry per agent) and
+# every tick advances all of them at once: ANN forward pass, motion,
+# collision, sensing and the statistics used by the fitness function.
+# The agents follow the same rules as utils.agent.Agent in a Simulation with
+# render=False, and can be on the same or on different maps.
+class BatchSimulation():
+    # maps: list of maps as returned by utils.map.read_map/get_maps
+    # weights: list with one (N, out, in) array per layer of the ANN
+    # scenarios: list of N (map_index, start_pos_index, radius, max_vision, ...)
+    def __init__(self, maps, weights, scenarios,
+                    max_speed=2.0,
+                    time=10, # in seconds
+                    time_step=10, # in ms, how often the ANN updates the motor speeds
+                    num_sensors=12
+                ):
+        self.n = len(scenarios)
+        self.max_speed = max_speed
+        self.time = time
+        self.time_step = time_step
+
+        # Same loop as in Simulation: 10ms per tick
+        self.tick_ms = 10
+        self.num_ticks = int(round(self.time * 1000 / self.tick_ms))
+        self.counter = 0
+
+        self.map_index = np.array([s[0] for s in scenarios])
+        self.radius = np.array([s[2] for s in scenarios], dtype=float)
+        self.max_vision = np.array([s[3] for s in scenarios], dtype=float)
+        self.l = self.radius * 2 # distance between the wheels
+
+        start = [maps[s[0]]["start_points"][s[1]] for s in scenarios]
+        self.x = np.array([p.X for p in start], dtype=float)
+        self.y = np.array([p.Y for p in start], dtype=float)
+        self.theta = np.zeros(self.n)
+
+        self.vl = np.zeros(self.n)
+        self.vr = np.zeros(self.n)
+
+        self.init_walls(maps)
+
+        self.angles = np.array(get_sensor_angles(num_sensors))
+        self.num_sensors = len(self.angles)
+        self.distances = np.full((self.n, self.num_sensors), -1.0)
+
+        # Collision state, same as in MotionModel
+        self.is_colliding = np.zeros(self.n, dtype=bool)
+        self.is_colliding2 = np.zeros(self.n, dtype=bool)
+        self.contact_wall = np.zeros((self.n, 4)) # wall of the first point of contact
+
+        # ANNs of all the agents
+        structure = [w.shape[1:] for w in weights]
+        self.network = PopulationNetwork(structure, self.n)
+        self.network.set_weights(weights)
+
+        # Data that is being collected in the simulation
+        self.num_agent_updates = 0
+        self.num_of_collisions = np.zeros(self.n, dtype=np.int64)
+        self.num_of_corner_collisions = np.zeros(self.n, dtype=np.int64)
+        self.counted_sensors = np.zeros(self.n, dtype=np.int64)
+        self.close_to_wall = np.zeros(self.n, dtype=np.int64)
+        self.far_from_wall = np.zeros(self.n, dtype=np.int64)
+        self.min_distance = np.full(self.n, 100000.0)
+        self.avg_sensor_distance = np.zeros(self.n)
+
+        # Area under the trajectory, accumulated with the trapezoidal rule
+        self.area = np.zeros(self.n)
+        self.prev_x = None
+        self.prev_y = None
+
+    def init_walls(self, maps):
+        # Walls of all the maps padded with NaN to the same length, every
+        # agent gets a view on the walls of its map
+        used = sorted(set(self.map_index.tolist()))
+        max_walls = max([len(maps[i]["grid"].walls) for i in used])
+
+        packed = np.full((len(maps), max_walls, 4), np.nan)
+        for i in used:
+            w = maps[i]["grid"].walls
+            packed[i, :len(w)] = w
+
+        self.walls = packed[self.map_index] # (N, W, 4)
+
+    def simulate(self):
+        for i in range(self.num_ticks):
+            self.step()
+        return self
+
+    def step(self):
+        # Update motor values from ANN
+        if self.counter == self.time_step:
+            self.ann_controller_run()
+            self.counter = 0
+
+        self.update()
+        self.counter = self.counter + self.tick_ms
+
+    def ann_controller_run(self):
+        # Shape the sensor feedback, same as Agent.ann_controller_run
+        d = self.distances
+        mv = self.max_vision[:, None]
+        A = 1000
+        alpha = 0.5
+        tau = 0.2
+        adjusted = np.where(d < 0, mv*1000, A + (A*alpha - A) * (1-np.exp(-(d/mv)/tau)))
+
+        # Forward pass for all the agents at once
+        output = self.network.run_network(adjusted)
+
+        l = output[:, 0]
+        r = output[:, 1]
+
+        # Above 0.5, speed is positive, under 0.5 speed is negative
+        c = 0.5
+        vl = (np.abs(l-c)/c)*self.max_speed
+        vr = (np.abs(r-c)/c)*self.max_speed
+        self.vl = np.where(l < c, -vl, vl)
+        self.vr = np.where(r < c, -vr, vr)
+
+    def move(self):
+        # Differential drive, same as MotionModel.update
+        return differential_drive_batch(self.x, self.y, self.theta, self.vl, self.vr, self.l)
+
+    def first_two(self, colliding):
+        # Indices of the first and second colliding wall of every agent
+        order = np.argsort(~colliding, axis=1, kind="stable")
+        return (order[:, 0], order[:, 1] if colliding.shape[1] > 1 else order[:, 0])
+
+    def update(self):
+        self.num_agent_updates = self.num_agent_updates + 1
+        rows = np.arange(self.n)
+
+        moving = (self.vl != 0) | (self.vr != 0)
+        (new_x, new_y, new_theta) = self.move()
+        direction = np.sign(self.vl + self.vr)
+
+        (colliding, distance, cx, cy) = get_collisions(self.walls, new_x[:, None], new_y[:, None], self.radius[:, None])
+        count = np.where(moving, colliding.sum(axis=1), 0)
+        (i1, i2) = self.first_two(colliding)
+
+        # One wall, first contact: snap the agent back along its heading
+        one = count == 1
+        snap = one & ~self.is_colliding
+        d = np.abs(distance[rows, i1])
+        snap_x = new_x - direction*d*np.cos(new_theta)
+        snap_y = new_y - direction*d*np.sin(new_theta)
+
+        # One wall, still in contact: slide along the wall of the first contact
+        slide = one & self.is_colliding
+        v = (self.vr + self.vl)/2
+        to_x = -direction*v*np.cos(self.theta)
+        to_y = -direction*v*np.sin(self.theta)
+        wx = self.contact_wall[:, 2] - self.contact_wall[:, 0]
+        wy = self.contact_wall[:, 3] - self.contact_wall[:, 1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            p = (to_x*wx + to_y*wy)/(wx*wx + wy*wy)
+        slide_x = self.x - p*wx
+        slide_y = self.y - p*wy
+
+        # Two walls, first contact: move to the intersection of the circles
+        # around both points of contact closest to the new position
+        two = count > 1
+        corner = two & ~self.is_colliding2
+        (corner_x, corner_y) = self.get_corner_position(
+            cx[rows, i1], cy[rows, i1], cx[rows, i2], cy[rows, i2], new_x, new_y)
+
+        # Two walls, still in contact: stay where we are
+        stuck = two & self.is_colliding2
+
+        new_x = np.select([snap, slide, corner, stuck], [snap_x, slide_x, corner_x, self.x], new_x)
+        new_y = np.select([snap, slide, corner, stuck], [snap_y, slide_y, corner_y, self.y], new_y)
+        new_theta = np.where(two, self.theta, new_theta)
+
+        # Remember the wall of the first point of contact for sliding
+        first = snap | corner
+        self.contact_wall[first] = self.walls[rows, i1][first]
+
+        self.is_colliding = np.where(moving, np.select([one, two], [True, True], False), self.is_colliding)
+        self.is_colliding2 = np.where(moving, np.select([one, two], [False, True], False), self.is_colliding2)
+
+        self.x = np.where(moving, new_x, self.x)
+        self.y = np.where(moving, new_y, self.y)
+        self.theta = np.where(moving, new_theta, self.theta)
+
+        if moving.any():
+            self.update_sensors(moving)
+        self.update_agent_data()
+
+    def get_corner_position(self, x0, y0, x1, y1, x, y):
+        # Intersections of two circles with the agent's radius, same as
+        # MotionModel.get_intersections. Where they don't intersect, the
+        # agent stays at (x, y).
+        r = self.radius
+        d = np.hypot(x1 - x0, y1 - y0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            a = d/2
+            h = np.sqrt(r**2 - a**2)
+            x2 = x0 + a*(x1 - x0)/d
+            y2 = y0 + a*(y1 - y0)/d
+            x3 = x2 + h*(y1 - y0)/d
+            y3 = y2 - h*(x1 - x0)/d
+            x4 = x2 - h*(y1 - y0)/d
+            y4 = y2 + h*(x1 - x0)/d
+
+        d1 = np.hypot(x - x3, y - y3)
+        d2 = np.hypot(x - x4, y - y4)
+        px = np.where(d2 < d1, x4, x3)
+        py = np.where(d2 < d1, y4, y3)
+
+        valid = (d > 0) & (d <= 2*r) & np.isfinite(px) & np.isfinite(py)
+        return (np.where(valid, px, x), np.where(valid, py, y))
+
+    def update_sensors(self, agents):
+        # Cast the sensors of the given agents against the walls of their maps
+        idx = np.flatnonzero(agents)
+        a = self.theta[idx][:, None] + self.angles
+        cos = np.cos(a).ravel()
+        sin = np.sin(a).ravel()
+
+        x = np.repeat(self.x[idx], self.num_sensors)
+        y = np.repeat(self.y[idx], self.num_sensors)
+        r = np.repeat(self.radius[idx], self.num_sensors)
+        mv = np.repeat(self.max_vision[idx], self.num_sensors)
+
+        starts = np.stack((x + r*cos, y + r*sin), axis=1)
+        ends = np.stack((x + (mv + r)*cos, y + (mv + r)*sin), axis=1)
+        walls = np.repeat(self.walls[idx], self.num_sensors, axis=0)
+
+        d = cast_rays(starts, ends, walls).reshape(len(idx), self.num_sensors)
+        self.distances[idx] = np.where(np.isfinite(d), np.round(d, 1), -1000)
+
+    def update_agent_data(self):
+        if self.prev_x is not None:
+            self.area += (self.x - self.prev_x)*(self.y + self.prev_y)/2
+            self.area += (self.y - self.prev_y)*(self.x + self.prev_x)/2
+        self.prev_x = self.x
+        self.prev_y = self.y
+
+        self.num_of_collisions += self.is_colliding
+        self.num_of_corner_collisions += self.is_colliding2
+
+        # Calculate sensor data, same as Agent.update_agent_data
+        d = self.distances
+        mv = self.max_vision[:, None]
+        valid = d >= 0
+
+        self.min_distance = np.minimum(self.min_distance, np.where(valid, d, np.inf).min(axis=1))
+
+        counted = valid.sum(axis=1)
+        self.counted_sensors += counted
+        self.far_from_wall += (valid & (d >= 0.5*mv)).sum(axis=1)
+        self.close_to_wall += (valid & (d < 0.3*mv)).sum(axis=1)
+
+        sum_distances = np.where(valid, d/mv, 0).sum(axis=1)
+        self.avg_sensor_distance += sum_distances/np.maximum(counted, 1)
+
+    # Statistics of every agent in the same form as fitness.summarize_agent
+    def get_summaries(self):
+        summaries = []
+        for i in range(self.n):
+            summaries.append({
+                "area": float(self.area[i]),
+                "num_of_collisions": int(self.num_of_collisions[i]),
+                "num_of_corner_collisions": int(self.num_of_corner_collisions[i]),
+                "num_agent_updates": self.num_agent_updates,
+                "counted_sensors": int(self.counted_sensors[i]),
+                "close_to_wall": int(self.close_to_wall[i]),
+                "far_from_wall": int(self.far_from_wall[i]),
+                "min_distance": float(self.min_distance[i]),
+                "avg_sensor_distance": float(self.avg_sensor_distance[i]),
+                "max_vision": float(self.max_vision[i]),
+                "skipped_updates": 0, # the batch always simulates whole episodes
+                "stop_reason": None
+            })
+        return summaries
@@ -8,6 +8,12 @@ import random as rnd
 import numpy as np
 import matplotlib.animation as animation
 import random
+import os
+import sys
+
+# The selection operators are shared with ER, one folder up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from selection import roulette_wheel_selection, tournament_selection
 
 
 def rosenbrock(*X):
@@ -66,7 +72,7 @@ class Individual:
 
 class EvolutionAlgorithm:
 
-    def __init__(self, max_fitness_val, population_size, bounds_left_wheel, bounds_right_wheel, fnc, cprob, mprob):
+    def __init__(self, max_fitness_val, population_size, bounds_left_wheel, bounds_right_wheel, fnc, cprob, mprob, selection="tournament"):
         self.max_fitness_val = max_fitness_val
         self.best_fitness = 0
         self.population_size = population_size
@@ -77,6 +83,7 @@ class EvolutionAlgorithm:
 
         self.cross_over_prob = cprob
         self.mutation_prob = mprob
+        self.selection = selection # "tournament" or "roulette"
 
         self.generation_index = 0
         self.current_generation = self.initial_population(population_size, bounds_left_wheel, bounds_right_wheel)
@@ -115,9 +122,11 @@ class EvolutionAlgorithm:
      
         
     def reproduction(self):
-        # Perform selection 
-        # Tournament selection + TODO: roullete wheel selection
-        parents = [self.tournament_selection() for i in range(self.population_size)]
+        # Perform selection, all parents at once
+        if self.selection == "roulette":
+            parents = self.roulette_wheel_selection()
+        else:
+            parents = self.tournament_selection()
 
         new_gen = []
         for i in range(0, self.population_size, 2):
@@ -130,23 +139,22 @@ class EvolutionAlgorithm:
 
         return new_gen
 
+    def get_fitness_values(self):
+        # Values of the functions can be arrays of one element
+        return np.array([np.ravel(v)[0] for v in self.fitness_values], dtype=float)
+
     def roulette_wheel_selection(self):
-        # Probabilities for each agent's speeds
-        fitness_sum = sum(self.fitness_values)
-        likelihood_selection = []
-        for value in self.fitness_values:
-            probability = value / fitness_sum
-            likelihood_selection.append(probability)
-        return likelihood_selection   
+        # The fitness is the negative function value, shifted so that
+        # the worst individual gets no part of the wheel
+        fitness = self.get_fitness_values()
+        fitness = fitness - fitness.min()
+        selected = roulette_wheel_selection(fitness, self.population_size)
+        return [self.current_generation[i] for i in selected]
 
     def tournament_selection(self):
-        # first random selection
         k = 3
-        selected = np.random.randint(len(self.current_generation))
-        for i in np.random.randint(0, len(self.current_generation), k-1):
-            if self.fitness_values[i] > self.fitness_values[selected]:
-                selected = i
-        return self.current_generation[selected]
+        selected = tournament_selection(self.get_fitness_values(), self.population_size, k)
+        return [self.current_generation[i] for i in selected]
 
 
     # ind_1 = [vl1, vr1]
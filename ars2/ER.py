@@ -1,30 +1,53 @@
 import sys
 import os
+import math
 import json
+import hashlib
+import queue
 import random
+import signal
 import numpy as np
 import multiprocessing as mp
+from multiprocessing import shared_memory
 import time
 import matplotlib.pyplot as plt
-import copy
 
 
 from utils.agent import Agent
-from Simulation import Simulation
-from ann import Dense, Network
-from utils.map import read_map, get_maps
+from Simulation import Simulation, TICK_MS
+from BatchSimulation import BatchSimulation
+from ann import Dense, Network, get_genome_size, split_genome
+from fitness import summarize_agent, calculate_fitness
+from utils.map import read_map, get_maps, create_map
+from fitness_cache import FitnessCache
+from curriculum import Curriculum
+from selection import selection_methods, roulette_wheel_selection, tournament_selection
 
 
 
 class Individual:
-    def __init__(self, generation, weights):
+    def __init__(self, generation, genome, structure):
         self.fitness = 0
-        self.weights = weights
+        self.genome = genome # all the weights as one flat vector
+        self.structure = structure
         self.generation = generation
         self.agent = None # Agent has the ann
         self.map_index = -1
-
-results = []
+        # The individual is simulated once in every scenario, one
+        # summary (and trajectory) per scenario
+        self.scenarios = list() # (map_index, pos_index, radius, vision, seed) of the simulations
+        self.summaries = list() # statistics of the simulations the fitness is computed from
+        self.trajectories = list() # (x, y) of every tick, only if ER returns trajectories
+        self.episode_time = None # length of the simulations in s
+        self.raw_fitness = 0 # fitness before it is made relative to the population
+
+    # Weights of every layer, as views into the genome
+    @property
+    def weights(self):
+        return split_genome(self.genome, self.structure)
+
+# State of an ER worker process, set once per process by init_worker
+worker = {}
 
 class ER:
     def __init__(self, 
@@ -37,7 +60,28 @@ class ER:
                 max_abs_speed = 2, # if max speed is 2, that means the robot is moving 200px/s
                 time_step = 100, # in ms
                 time = 10, # in seconds
-                weights_dir="./weights"
+                weights_dir="./weights",
+                raycast = "numpy", # "table" reads the sensors from the precomputed sensor tables of the maps
+                engine = "agent", # "batch" simulates the whole generation at once in this process
+                processes = None, # number of worker processes, by default the number of CPU cores
+                return_trajectory = False, # workers also send back the trajectory of the agents
+                shared_memory = False, # population and walls are shared with the workers, tasks only carry row indices
+                cache_size = 0, # number of simulation results kept in the fitness cache, 0 disables the cache
+                cache_path = None, # json file the fitness cache is loaded from and saved to
+                stop_rules = None, # rules to stop hopeless episodes early, see early_stop.py
+                scenarios_per_generation = 0, # K > 0 evaluates all individuals on the same K scenarios
+                scenario_seed = None, # seed of the scenarios of each generation, random by default
+                steady_state = False, # no generations, a child is bred as soon as any simulation is done
+                generation_callback = None, # called with the ER after the best individual of a generation is found
+                checkpoint_interval = 1, # write a checkpoint every this many generations, 0 disables them
+                selection = "roulette", # "roulette", "sus", "tournament" or "rank", see selection.py
+                curriculum = None, # Curriculum that makes the episodes longer over the run, up to time
+                task_timeout = None, # seconds a simulation may take in a worker, None waits forever
+                max_retries = 1, # a failed or timed out simulation is tried again this many times
+                failure_fitness = None, # fitness of an individual whose simulation failed every time, by default the lowest fitness of its generation
+                physics_step = 1, # ticks of 10ms simulated per update of the agent
+                continuous_collisions = False, # continuous collision detection, keeps the agents inside the maps with large physics steps
+                skip_ahead = False # event-driven stepping in open space, same results, see Agent.plan_updates
                 ):
         self.maps = maps
 
@@ -46,10 +90,87 @@ class ER:
         self.mutation_prob = mutation_prob
         self.number_of_generations = number_of_generations
 
+        if selection not in selection_methods:
+            print("Unknown selection " + str(selection) + "!")
+            sys.exit()
+        self.selection = selection_methods[selection]
+
         self.ann = ann
         self.max_abs_speed = max_abs_speed
         self.time_step = time_step
         self.time = time
+        self.raycast = raycast
+
+        # An update of the agent covers physics_step ticks
+        self.physics_step = physics_step
+        self.continuous_collisions = continuous_collisions
+        self.skip_ahead = skip_ahead # only used by the agent engine, the batch engine steps all agents together
+        self.tick_ms = TICK_MS * physics_step
+
+        # The curriculum changes the episode length, the fitness stays
+        # comparable across lengths (see calculate_fitness)
+        self.curriculum = curriculum
+        self.engine = engine
+
+        self.processes = processes
+        if self.processes is None:
+            self.processes = mp.cpu_count()
+        self.pool = None
+        self.return_trajectory = return_trajectory
+
+        # A simulation that raises, or that runs longer than task_timeout, is
+        # dispatched again and finally gets failure_fitness, so one bad
+        # simulation can't stall or crash the run. The fitness can be
+        # negative, so by default a failure gets the lowest fitness of the
+        # generation (of the population in steady state) and never ranks
+        # above a simulated individual.
+        self.task_timeout = task_timeout
+        self.max_retries = max_retries
+        self.failure_fitness = failure_fitness
+        self.in_flight = dict() # task id -> [task, attempts, deadline]
+        self.task_stats = self.get_empty_task_stats()
+
+        self.shared_memory = shared_memory
+        self.shm_genomes = None
+        self.shm_walls = None
+        self.shared_genomes = None
+
+        # The batch engine always simulates whole episodes
+        self.stop_rules = stop_rules
+        # Best fitness on every map in the last generation, used by the stop rules
+        self.elite_fitness = dict()
+
+        # Clones of a parent keep the parent's scenario, so their
+        # simulation results can be taken from the cache
+        self.fitness_cache = None
+        if cache_size > 0:
+            self.fitness_cache = FitnessCache(cache_size, cache_path, self.get_settings_fingerprint())
+
+        # Common random numbers: in a generation every individual is simulated
+        # in the same K scenarios and its fitness is the average over the
+        # scenarios of its fitness relative to the population's average in
+        # that scenario, instead of the fitness in one random scenario
+        self.scenarios_per_generation = scenarios_per_generation
+        self.scenario_seed = scenario_seed
+
+        # Steady state evolution runs the same number of simulations as the
+        # generational one, population_size simulations count as a generation
+        self.steady_state = steady_state
+        if self.steady_state and self.engine == "batch":
+            print("The batch engine can't be used for steady state evolution!")
+            sys.exit()
+        if self.steady_state and self.scenarios_per_generation > 0:
+            # Every individual gets its own scenario when it is simulated
+            print("Common scenarios can't be used for steady state evolution!")
+            sys.exit()
+        if self.physics_step != 1 and self.engine == "batch":
+            print("The batch engine only simulates single ticks!")
+            sys.exit()
+
+        # The callback can add genomes from elsewhere (e.g. other islands of
+        # an island model) to immigrants, they replace children of the next generation
+        self.generation_callback = generation_callback
+        self.immigrants = list()
 
         self.generation_index = 0
         self.current_generation = self.initialize_population()
@@ -60,26 +181,52 @@ class ER:
 
         self.avg_by_map = []
 
+        # The checkpoint holds the evaluated population of a generation, from
+        # which ER.resume continues the run. Statistics of every generation
+        # are appended to the run log.
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_path = os.path.join(self.weights_dir, "checkpoint.npz")
+        self.run_log_path = os.path.join(self.weights_dir, "run_log.jsonl")
+        self.evaluated = False # the current generation was evaluated already (after resume)
+        self.num_simulations = 0 # episodes simulated so far, without the ones from the fitness cache
+
+
+    # Hash of everything besides the genome, the scenario and the length of
+    # the episode that decides the summary of a simulation
+    def get_settings_fingerprint(self):
+        maps = list()
+        for m in self.maps:
+            walls = np.ascontiguousarray(m["grid"].walls, dtype=np.float64)
+            start_points = [(p.X, p.Y) for p in m["start_points"]]
+            maps.append([hashlib.sha1(walls.tobytes()).hexdigest(), start_points])
+
+        rules = [[type(r).__name__, sorted(vars(r).items())] for r in (self.stop_rules or [])]
+        settings = {
+            "maps": maps,
+            "structure": self.ann.get_structure(),
+            "time_step": self.time_step,
+            "max_abs_speed": self.max_abs_speed,
+            "raycast": self.raycast,
+            "engine": self.engine,
+            "physics_step": self.physics_step,
+            "continuous_collisions": self.continuous_collisions,
+            "stop_rules": rules
+        }
+        return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
 
     def initialize_population(self):
         structure = self.ann.get_structure()
-        population = list()
-
-        for i in range(self.population_size):
-            weights = list()
-            for j in range(len(structure)):
-                s = structure[j]
-                w = np.random.rand(s[0], s[1])
-
-                # go over each element in w and set it to some small number instead
-                for iw in range(len(w)):
-                    for jw in range(len(w[iw])):
-                        w[iw][jw] = random.uniform(-0.1,0.1)
 
-                weights.append(w)
-            i = Individual(self.generation_index, weights)
-            population.append(i)
+        # One row per individual, every weight is set to some small number
+        genomes = np.random.uniform(-0.1, 0.1, (self.population_size, get_genome_size(structure)))
+        return self.create_individuals(genomes, [self.generation_index]*self.population_size)
 
+    # Individuals whose genomes are the rows of the genomes matrix
+    def create_individuals(self, genomes, generations):
+        structure = self.ann.get_structure()
+        population = list()
+        for i in range(len(genomes)):
+            population.append(Individual(generations[i], genomes[i], structure))
         return population
 
 
@@ -89,106 +236,388 @@ class ER:
         # then calculate the fitness by the properties of the agent
         print("Generation: " + str(self.generation_index))
 
-        # We parallelize the process so we can quickly evaluate the entire generation
-        print("Number of CPU cores: " + str(mp.cpu_count()))
-
         t = time.time()
 
-        pool = mp.Pool(mp.cpu_count())
-        # Step 3: Use loop to parallelize
-        for i, individual in enumerate(self.current_generation):
-            pool.apply_async(simulate, args=(
-                i, 
-                individual, 
-                self.maps, 
-                self.ann,
-                self.time,
-                self.time_step,
-                self.max_abs_speed
-                ), callback=collect_result)
-
-        pool.close()
-        pool.join()
+        episode_time = self.get_episode_time()
+        if self.curriculum is not None:
+            print("Episode length: " + str(episode_time) + " s")
 
-        el = "Elapsed time: " + str(time.time() - t)
-        print(el)
+        self.set_scenarios()
+        for ind in self.current_generation:
+            ind.episode_time = episode_time
+        self.task_stats = self.get_empty_task_stats()
 
-        # Now we loop over the individual agents in results and calculate their fittness
-        global results
-        self.current_generation = list()
+        pending = self.get_cached_summaries()
 
-        num_individ = len(results)
-        for i in range(num_individ):
-            ind = results[i]
-            ind.fitness = self.calculate_fitness(ind.agent)
-            self.current_generation.append(ind)
+        if len(pending) > 0:
+            if self.engine == "batch":
+                self.evaluate_fitness_batch(pending)
+            else:
+                self.evaluate_fitness_pool(pending)
 
-        results = []
+        self.print_early_stops(pending)
+        self.print_task_stats()
+        self.num_simulations = self.num_simulations + len(pending)
 
+        if self.fitness_cache is not None:
+            for (i, j) in pending:
+                ind = self.current_generation[i]
+                # Whether the episode was stopped depends on the elite at the time
+                if ind.summaries[j] is None or ind.summaries[j].get("stop_reason") == "fitness_bound":
+                    continue
+                self.fitness_cache.put(FitnessCache.get_key(ind.genome, ind.scenarios[j], ind.episode_time), ind.summaries[j])
+            self.fitness_cache.save()
 
+        el = "Elapsed time: " + str(time.time() - t)
+        print(el)
 
-    def calculate_fitness(self, agent):
-        # Fitness function based on the data the agent has collected
+        # Now we loop over the individuals and calculate their fittness
+        # (individual x scenario)
+        simulated = [calculate_fitness(s) for ind in self.current_generation for s in ind.summaries if s is not None]
+        worst = min(simulated, default=0)
+        fitness = np.array([[self.calculate_summary_fitness(s, worst) for s in ind.summaries] for ind in self.current_generation])
+        for i, ind in enumerate(self.current_generation):
+            ind.raw_fitness = fitness[i].mean()
+
+        if self.scenarios_per_generation > 0:
+            # Relative to the average of the scenario, like find_best does per map
+            avg = fitness.mean(axis=0)
+            avg[avg <= 0] = 1
+            fitness = fitness / avg
+
+        for i, ind in enumerate(self.current_generation):
+            ind.map_index = ind.scenarios[0][0]
+            ind.fitness = fitness[i].mean()
+
+        # The stop rules compare the fitness in one episode
+        self.elite_fitness = dict()
+        for ind in self.current_generation:
+            for (scenario, summary) in zip(ind.scenarios, ind.summaries):
+                if summary is None:
+                    continue
+                f = self.calculate_summary_fitness(summary)
+                if f > self.elite_fitness.get(scenario[0], -math.inf):
+                    self.elite_fitness[scenario[0]] = f
+
+    def get_episode_time(self):
+        if self.curriculum is None:
+            return self.time
+        return self.curriculum.get_time(self.generation_index)
+
+    # Fitness of a summary, a failed simulation has no summary and gets failure_fitness or else worst
+    def calculate_summary_fitness(self, summary, worst=0):
+        if summary is None:
+            if self.failure_fitness is None:
+                return worst
+            return self.failure_fitness
+        return calculate_fitness(summary)
+
+    # The elite of the map for the stop rules
+    def get_task_elite(self, scenario):
+        return self.elite_fitness.get(scenario[0])
+
+    def set_scenarios(self):
+        if self.scenarios_per_generation > 0:
+            rng = random
+            if self.scenario_seed is not None:
+                rng = random.Random(self.scenario_seed + self.generation_index)
+            scenarios = [create_scenario(self.maps, rng) for k in range(self.scenarios_per_generation)]
+            for ind in self.current_generation:
+                ind.scenarios = list(scenarios)
+        else:
+            # Individuals that weren't simulated yet get a new scenario
+            for ind in self.current_generation:
+                if len(ind.scenarios) == 0:
+                    ind.scenarios = [create_scenario(self.maps)]
+
+        for ind in self.current_generation:
+            ind.summaries = [None]*len(ind.scenarios)
+            ind.trajectories = [None]*len(ind.scenarios)
+
+    def print_early_stops(self, pending):
+        if not self.stop_rules:
+            return
+        stopped = 0
+        skipped = 0
+        for (i, j) in pending:
+            summary = self.current_generation[i].summaries[j]
+            if summary is not None and summary.get("stop_reason") is not None:
+                stopped = stopped + 1
+                skipped = skipped + summary["skipped_updates"]
+        print("Episodes stopped early: " + str(stopped) + "/" + str(len(pending))
+                + ", simulated seconds saved: " + str(round(skipped*self.tick_ms/1000, 2)))
+
+    # Takes the summaries of the individuals from the fitness cache and
+    # returns the (individual, scenario) indices that still have to be simulated
+    def get_cached_summaries(self):
+        pending = list()
+        for i, ind in enumerate(self.current_generation):
+            for j in range(len(ind.scenarios)):
+                pending.append((i, j))
+
+        if self.fitness_cache is None:
+            return pending
+
+        self.fitness_cache.reset_stats()
+        not_cached = list()
+        for (i, j) in pending:
+            ind = self.current_generation[i]
+            summary = self.fitness_cache.get(FitnessCache.get_key(ind.genome, ind.scenarios[j], ind.episode_time))
+            if summary is None:
+                not_cached.append((i, j))
+            else:
+                ind.summaries[j] = summary
 
-        # Area
-        x = agent.x_coord
-        max_x = max(x)
-        min_x = min(x)
-        y = agent.y_coord 
-        max_y = max(y)
-        min_y = min(y)
+        c = self.fitness_cache
+        print("Fitness cache hits: " + str(c.hits) + "/" + str(c.hits + c.misses)
+                + " (" + str(round(100*c.get_hit_rate(), 1)) + "%), simulations saved: " + str(c.hits))
+        return not_cached
 
-        diff_x = max_x - min_x
-        diff_y = max_y - min_y
-        diff = diff_x + diff_y
-        areax = np.trapz(y=y, x=x)
-        areay = np.trapz(y=x, x=y)
-        A = (areax+areay)
+    def evaluate_fitness_pool(self, pending):
+        # We parallelize the process so we can quickly evaluate the entire generation
+        print("Number of worker processes: " + str(self.processes))
+
+        # The pool normally lives for the whole run_er call
+        own_pool = self.pool is None
+        if own_pool:
+            self.start_pool()
+
+        # Every task only carries the genome and the scenario to simulate.
+        # With shared memory the genomes are written to the shared population
+        # matrix and the workers read their row.
+        if self.shared_memory:
+            self.shared_genomes[:len(self.current_generation)] = [ind.genome for ind in self.current_generation]
+
+        tasks = list()
+        for (i, j) in pending:
+            individual = self.current_generation[i]
+            genome = None if self.shared_memory else individual.genome
+            scenario = individual.scenarios[j]
+            elite = self.get_task_elite(scenario)
+            tasks.append((i, genome, scenario, elite, individual.episode_time))
+
+        # Only as many tasks as there are workers are dispatched at a time,
+        # so a task starts when it is dispatched and its deadline is right.
+        # Workers only send back the statistics needed for the fitness.
+        results = queue.Queue()
+        submitted = 0
+        for k in range(len(tasks)):
+            while len(self.in_flight) < self.processes and submitted < len(tasks):
+                self.submit_task(submitted, tasks[submitted], results)
+                submitted = submitted + 1
+
+            (task_id, summary, trajectory) = self.get_task_result(results)
+            (i, j) = pending[task_id]
+            individual = self.current_generation[i]
+            individual.summaries[j] = summary
+            individual.trajectories[j] = trajectory
+
+        if own_pool:
+            self.stop_pool()
+
+
+    def get_empty_task_stats(self):
+        return {"timeouts": 0, "failures": 0, "retries": 0, "penalized": 0, "restarts": 0}
+
+    def print_task_stats(self):
+        stats = self.task_stats
+        if sum(stats.values()) == 0:
+            return
+        print("Timeouts: " + str(stats["timeouts"]) + ", failures: " + str(stats["failures"])
+                + ", retries: " + str(stats["retries"]) + ", penalized: " + str(stats["penalized"])
+                + ", pool restarts: " + str(stats["restarts"]))
+
+    def submit_task(self, task_id, task, results, attempts=0):
+        # The worker stops the simulation itself after task_timeout, the
+        # deadline only matters if the worker can't be interrupted
+        deadline = None
+        if self.task_timeout is not None:
+            deadline = time.time() + self.task_timeout + max(self.task_timeout, 5)
+        self.in_flight[task_id] = [task, attempts, deadline]
+        self.pool.apply_async(run_task, (task_id, task, self.task_timeout),
+                                callback=results.put,
+                                error_callback=lambda e, k=task_id: results.put((k, "error", repr(e))))
+
+    # Waits for the next finished task and returns (task id, summary, trajectory).
+    # Failed tasks are dispatched again, after max_retries their summary is None.
+    def get_task_result(self, results):
+        while True:
+            deadlines = [d for (task, attempts, d) in self.in_flight.values() if d is not None]
+            wait = None
+            if len(deadlines) > 0:
+                wait = max(min(deadlines) - time.time(), 0)
+
+            try:
+                (task_id, status, result) = results.get(timeout=wait)
+            except queue.Empty:
+                self.restart_pool(results)
+                continue
+
+            # Results of tasks that were dispatched again after a restart
+            if task_id not in self.in_flight:
+                continue
+
+            if status == "ok":
+                del self.in_flight[task_id]
+                (summary, trajectory) = result
+                return (task_id, summary, trajectory)
+
+            if status == "timeout":
+                self.task_stats["timeouts"] = self.task_stats["timeouts"] + 1
+            else:
+                self.task_stats["failures"] = self.task_stats["failures"] + 1
+                print("Simulation failed: " + str(result))
+
+            (task, attempts, deadline) = self.in_flight.pop(task_id)
+            if attempts < self.max_retries:
+                self.task_stats["retries"] = self.task_stats["retries"] + 1
+                self.submit_task(task_id, task, results, attempts + 1)
+                continue
+
+            self.task_stats["penalized"] = self.task_stats["penalized"] + 1
+            return (task_id, None, None)
+
+    # Some worker is stuck past its deadline and doesn't react to the timeout.
+    # The pool is replaced, the overdue tasks count as timed out and the other
+    # tasks in flight are dispatched again.
+    def restart_pool(self, results):
+        self.task_stats["restarts"] = self.task_stats["restarts"] + 1
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = mp.Pool(self.processes, initializer=init_worker, initargs=self.pool_initargs)
+
+        now = time.time()
+        in_flight = self.in_flight
+        self.in_flight = dict()
+        for (task_id, (task, attempts, deadline)) in in_flight.items():
+            if deadline is not None and deadline <= now:
+                # Handled like a timeout reported by the worker
+                self.in_flight[task_id] = [task, attempts, None]
+                results.put((task_id, "timeout", None))
+            else:
+                self.submit_task(task_id, task, results, attempts)
+
+    def start_pool(self):
+        # Worker processes get the maps and the settings of the simulation
+        # only once, when they are started
+        maps = self.maps
+        shared = None
+        if self.shared_memory:
+            maps = None
+            shared = self.create_shared_memory()
+
+        self.pool_initargs = (
+                maps,
+                self.ann.get_structure(),
+                self.time_step,
+                self.max_abs_speed,
+                self.raycast,
+                self.return_trajectory,
+                shared,
+                self.stop_rules,
+                self.physics_step,
+                self.continuous_collisions,
+                self.skip_ahead
+            )
+        self.pool = mp.Pool(self.processes, initializer=init_worker, initargs=self.pool_initargs)
+
+    def stop_pool(self):
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+
+        if self.shared_memory:
+            self.free_shared_memory()
+
+    def create_shared_memory(self):
+        # The population matrix
+        size = (self.population_size, get_genome_size(self.ann.get_structure()))
+        self.shm_genomes = shared_memory.SharedMemory(create=True, size=max(size[0]*size[1]*8, 1))
+        self.shared_genomes = np.ndarray(size, dtype=np.float64, buffer=self.shm_genomes.buf)
+
+        # The walls of all maps, one after the other
+        walls = np.concatenate([m["grid"].walls for m in self.maps])
+        self.shm_walls = shared_memory.SharedMemory(create=True, size=max(walls.nbytes, 1))
+        shared_walls = np.ndarray(walls.shape, dtype=np.float64, buffer=self.shm_walls.buf)
+        shared_walls[:] = walls
+        del shared_walls
+
+        # What the workers need to rebuild the maps around the shared walls
+        maps = list()
+        start = 0
+        for m in self.maps:
+            end = start + len(m["grid"].walls)
+            start_points = [(p.X, p.Y) for p in m["start_points"]]
+            maps.append((start, end, start_points, m["index"], m.get("sensor_table")))
+            start = end
+
+        return {
+            "genomes": (self.shm_genomes.name, size),
+            "walls": (self.shm_walls.name, walls.shape),
+            "maps": maps
+        }
 
-        # Punishment collisions
-        col = agent.num_of_collisions
-        upd = agent.num_agent_updates      
-        P = col/upd
-        if col>0:
-            P = 0.95
+    def free_shared_memory(self):
+        # The arrays must be released before the memory can be closed
+        self.shared_genomes = None
+        for shm in (self.shm_genomes, self.shm_walls):
+            shm.close()
+            shm.unlink()
+        self.shm_genomes = None
+        self.shm_walls = None
 
-        # Penalty for colliding into a corner
-        corner_penalty = 1.0
-        if(agent.num_of_corner_collisions > 0):
-            corner_penalty = 0.00001
 
-        if agent.counted_sensors == 0:
-            agent.counted_sensors = 1
+    def evaluate_fitness_batch(self, pending):
+        # All pending individuals of the generation are simulated in lockstep
+        individuals = [self.current_generation[i] for (i, j) in pending]
+        scenarios = [self.current_generation[i].scenarios[j] for (i, j) in pending]
+        genomes = np.stack([ind.genome for ind in individuals])
+        weights = split_genome(genomes, self.ann.get_structure())
 
-        # Reward for large  min_distance
-        min_penalty = (agent.min_distance/agent.max_vision)
+        sim = BatchSimulation(self.maps, weights, scenarios,
+                                max_speed=self.max_abs_speed,
+                                time=individuals[0].episode_time,
+                                time_step=self.time_step)
+        summaries = sim.simulate().get_summaries()
 
-        # Punishment for amount of time being too close to the walls
-        close_penalty = (agent.close_to_wall/agent.counted_sensors)**2
+        for k, (i, j) in enumerate(pending):
+            self.current_generation[i].summaries[j] = summaries[k]
 
-        # Reward for amount of time being a good distance from the walls
-        far_reward = (agent.far_from_wall/agent.counted_sensors)**2
 
-        # A medium-high sensor distance average is good, low is bad
-        if(agent.num_agent_updates == 0):
-            agent.num_agent_updates = 1
-        avg_sensor_dist = (agent.avg_sensor_distance/agent.num_agent_updates)
+    def calculate_fitness(self, agent):
+        # Fitness function based on the data the agent has collected
+        return self.calculate_summary_fitness(summarize_agent(agent))
 
-        F = 0.0001*A*(1-P)*corner_penalty*avg_sensor_dist*1000*far_reward*500*(1-close_penalty)*min_penalty
-        return F
 
+    # None of the simulations of the individual succeeded
+    def is_failed(self, ind):
+        return len(ind.summaries) > 0 and all([s is None for s in ind.summaries])
 
     def find_best(self):
+        # With common scenarios the fitness is already relative to the scenarios
         for g in self.current_generation:
+            if self.scenarios_per_generation > 0:
+                break
             if self.avg_by_map[g.map_index] == 0 or self.avg_by_map[g.map_index] == None:
                 self.avg_by_map[g.map_index] = 1
             g.fitness = g.fitness/self.avg_by_map[g.map_index]
-        
+
+        # A failure can be alone on its map, it gets the lowest fitness after
+        # the normalisation
+        if self.scenarios_per_generation == 0:
+            failed = [g for g in self.current_generation if self.is_failed(g)]
+            worst = min([g.fitness for g in self.current_generation if not self.is_failed(g)], default=0)
+            for g in failed:
+                g.fitness = self.calculate_summary_fitness(None, worst)
+
         self.current_generation.sort(key=lambda x: x.fitness, reverse=True)
 
         best = self.current_generation[0]
         self.best_in_generation.append(best)
+        self.save_weights(best)
+        return best
 
+    def save_weights(self, best):
         # Write the weights to the disk 
         gen = "generation_"+str(best.generation)+"_weights.json"
         file = os.path.join(self.weights_dir,gen)
@@ -198,11 +627,10 @@ class ER:
             serialized_weights.append(
                 w.tolist()
             )
-        serialized_weights = json.dumps(serialized_weights)
 
+        # The history of the run is in the run log
         data = {
             "best_fitness":best.fitness,
-            "avg_fitness":self.avg_fitness,
             "cross_over_prob":self.cross_over_prob,
             "mutation_prob":self.mutation_prob,
             "population_size":self.population_size,
@@ -213,206 +641,558 @@ class ER:
         }
         with open(file, 'w') as outfile:
             json.dump(data, outfile, indent=4)
-        
-        return best
 
 
+    # n parents from the current generation, drawn all at once
+    def select_parents(self, n):
+        fitness = np.array([c.fitness for c in self.current_generation])
+        return [self.current_generation[i] for i in self.selection(fitness, n)]
+
     def roullete_wheel_selection(self):
-        max  = sum([c.fitness for c in self.current_generation])
-        pick = random.uniform(0, max)
-        current = 0
-        for g in self.current_generation:
-            current += g.fitness
-            if current > pick:
-                return g
+        fitness = np.array([c.fitness for c in self.current_generation])
+        return self.current_generation[roulette_wheel_selection(fitness, 1)[0]]
 
     def tournament_selection(self):
-        # First random selection
-        k = 7
-        selected = np.random.randint(len(self.current_generation))
-        for i in np.random.randint(0, len(self.current_generation), k-1):
-            if self.current_generation[i].fitness > self.current_generation[selected].fitness:
-                selected = i
-        return self.current_generation[selected]
-
-
-    # ind_1 = Individual(weights1)
-    # ind_2 = Individual(weights2)
-    def cross_over(self, individual_1, individual_2):
-    
-        child_1 = individual_1
-        child_2 = individual_2
-
-        w1 = child_1.weights
-        w2 = child_2.weights
-        if random.uniform(0,1) <= self.cross_over_prob:
-            # Select randomly a layer, select a cross-over point and cross-over the weights
-            num_layers = len(w1)
-            i = random.randint(0,num_layers-1)
-
-            l1 = w1[i]
-            l2 = w2[i]
-            point = random.randint(1,len(l1)-1)
-
-            # l1 gets left/right of point of l2
-            coin = random.randint(0,1)
-            if coin == 0:
-                tmp = l1[:point].copy()
-                l1[:point] = l2[:point]
-                l2[:point] = tmp
-            else:
-                tmp = l1[point:].copy()
-                l1[point:] = l2[point:]
-                l2[point:] = tmp
-                
-            w1[i] = l1
-            w2[i] = l2
-
-
-        child_1.weights = w1
-        child_2.weights = w2
-
-        return child_1, child_2
-
-
-    def mutation(self, individual):
-        w = individual.weights
-        if random.uniform(0,1) < self.mutation_prob:
-            # Go through each layer of weights, randomly select one list
-            # and mutate every value
-            for i in range(len(w)):
-                layer = w[i]
-                mutation_index = random.randint(0, len(layer)-1)
-
-                wl = layer[mutation_index]
-                rand_num = np.random.randint(0,len(wl)-1, random.randint(1,len(wl)))
-               
-                # Mutate random amount of values
-                # Requires a bit of expirementation...
-                for j in range(len(rand_num)):
-                    r = random.uniform(0, 1)
-                    c = random.randint(0,1)
-                    tmp = wl[rand_num[j]]
-                    if c == 0:
-                        tmp = tmp + tmp*r
-                    else:
-                        tmp = tmp - tmp*r
-
-                    wl[rand_num[j]] = tmp
-                
-                layer[mutation_index] = wl
-
-        individual.weights = w
-        return individual
+        fitness = np.array([c.fitness for c in self.current_generation])
+        return self.current_generation[tournament_selection(fitness, 1, 7)[0]]
 
 
-    def reproduction(self):
-        # Perform selection
-        parents = [self.roullete_wheel_selection() for i in range(self.population_size)]
+    # Precomputes for every gene in the genome its layer and the row within
+    # the layer, used to build the cross-over masks
+    def get_gene_layout(self):
+        structure = self.ann.get_structure()
+        layers = list()
+        rows = list()
+        for i in range(len(structure)):
+            (out, inp) = structure[i]
+            layers.append(np.full(out*inp, i))
+            rows.append(np.repeat(np.arange(out), inp))
+        return (np.concatenate(layers), np.concatenate(rows))
+
 
-        new_gen = list()
-        for i in range(0, self.population_size, 2):
-            p1 = copy.deepcopy(parents[i])
-            p2 = copy.deepcopy(parents[i + 1])
-            
-            #print("Generation p1,p2 " + str(p1.generation) + "," + str(p2.generation))
-            # Perform crossover and then mutation
-            for child in self.cross_over(p1, p2):
-                new_c = self.mutation(child)
-                new_c.generation = child.generation + 1
-                new_gen.append(new_c)        
+    # Cross-over of consecutive pairs of genomes (rows 0-1, 2-3, ...), in place
+    def cross_over(self, genomes):
+        structure = self.ann.get_structure()
+        num_pairs = len(genomes) // 2
+        (gene_layer, gene_row) = self.get_gene_layout()
 
-        self.current_generation = new_gen
+        # For every pair: select randomly a layer, select a cross-over point and
+        # whether the rows left or right of the point are exchanged
+        do = np.random.uniform(0, 1, num_pairs) <= self.cross_over_prob
+        layer = np.random.randint(0, len(structure), num_pairs)
+        num_rows = np.array([s[0] for s in structure])[layer]
+        point = np.random.randint(1, np.maximum(num_rows, 2))
+        coin = np.random.randint(0, 2, num_pairs)
 
+        left = gene_row[None, :] < point[:, None]
+        mask = do[:, None] & (gene_layer[None, :] == layer[:, None]) & (left != (coin[:, None] == 1))
 
+        g1 = genomes[0:2*num_pairs:2]
+        g2 = genomes[1:2*num_pairs:2]
+        genomes[0:2*num_pairs:2] = np.where(mask, g2, g1)
+        genomes[1:2*num_pairs:2] = np.where(mask, g1, g2)
+        return genomes
 
 
-    def run_er(self):
+    # Mutation of the genomes, in place
+    def mutation(self, genomes):
+        structure = self.ann.get_structure()
+        mutated = np.flatnonzero(np.random.uniform(0, 1, len(genomes)) < self.mutation_prob)
+        if len(mutated) == 0:
+            return genomes
 
-        best_fitness = []
-        for i in range(self.number_of_generations):
+        # Go through each layer of weights, randomly select one row and
+        # mutate a random amount of values in it
+        # Requires a bit of expirementation...
+        offset = 0
+        for (rows, cols) in structure:
+            m = len(mutated)
+            row = np.random.randint(0, rows, m)
+            amount = np.random.randint(1, cols + 1, m)
+            col = np.random.randint(0, max(cols - 1, 1), (m, cols))
+            selected = np.arange(cols)[None, :] < amount[:, None]
 
-            # Evaluate fitness of current generation
-            self.evaluate_fitness()
+            r = np.random.uniform(0, 1, (m, cols))
+            sign = np.where(np.random.randint(0, 2, (m, cols)) == 0, 1, -1)
+            factor = 1 + sign*r
 
-            # Find best individual in the current generation 
-            # and save its weights to disk
+            individual = np.repeat(mutated[:, None], cols, axis=1)
+            gene = offset + row[:, None]*cols + col
 
-            self.avg_by_map = []
+            # multiply.at so that values selected more than once are mutated more than once
+            np.multiply.at(genomes, (individual[selected], gene[selected]), factor[selected])
+            offset = offset + rows*cols
 
-            i = 0
-            for m in self.maps:
-                avg = 0
-                count = 0
-                for g in self.current_generation:
-                    if g.agent.map["index"] == i:
-                        avg = avg + g.fitness
-                        count = count + 1
-                avg = avg/count
-                if count == 0:
-                    avg = 1
-                self.avg_by_map.append(avg)
+        return genomes
+
+
+    def reproduction(self):
+        # Perform selection
+        parents = self.select_parents(self.population_size)
+
+        # Copy the genomes of the parents into a new population matrix and
+        # perform crossover and then mutation on the whole matrix
+        genomes = np.stack([p.genome for p in parents])
+        genomes = self.cross_over(genomes)
+        genomes = self.mutation(genomes)
+
+        generations = [p.generation + 1 for p in parents]
+        self.current_generation = self.create_individuals(genomes, generations)
+
+        # Children identical to their parent are simulated in the parent's
+        # scenario again, which the fitness cache already knows
+        if self.fitness_cache is not None and self.scenarios_per_generation == 0:
+            clones = np.all(genomes == np.stack([p.genome for p in parents]), axis=1)
+            for i in np.flatnonzero(clones):
+                self.current_generation[i].scenarios = list(parents[i].scenarios)
 
-                i = i+1
 
-            self.avg_fitness.append(avg)
 
 
-            best = self.find_best()
-            best_fitness.append(best.fitness)
+    def run_er(self):
+        if self.engine != "batch":
+            self.start_pool()
+        try:
+            if self.steady_state:
+                self.run_steady_state()
+            else:
+                self.run_generations()
+        finally:
+            if self.pool is not None:
+                self.stop_pool()
 
-            print("Best fitness: " + str(best.fitness))
-            print("Average fitness: " + str(avg))
 
+    def run_generations(self):
+        while self.generation_index < self.number_of_generations:
+            # After a resume the population of the checkpoint is already evaluated
+            if not self.evaluated:
+                self.evaluate_generation()
+            self.evaluated = False
 
             # Reproduction includes selection + mutation
             self.reproduction()
+            self.insert_immigrants()
             self.generation_index = self.generation_index + 1
 
             print("----------------")
 
+    def evaluate_generation(self):
+        t = time.time()
+
+        # Evaluate fitness of current generation
+        self.evaluate_fitness()
+
+        # Find best individual in the current generation 
+        # and save its weights to disk
+
+        self.avg_by_map = []
+
+        i = 0
+        for m in self.maps:
+            avg = 0
+            count = 0
+            for g in self.current_generation:
+                if g.map_index == i and not self.is_failed(g):
+                    avg = avg + g.fitness
+                    count = count + 1
+            if count == 0:
+                avg = 1
+            else:
+                avg = avg/count
+            self.avg_by_map.append(avg)
+
+            i = i+1
 
+        self.avg_fitness.append(avg)
 
 
+        best = self.find_best()
 
+        print("Best fitness: " + str(best.fitness))
+        print("Average fitness: " + str(avg))
 
-def collect_result(result):
-    global results
-    results.append(result)
+        if self.generation_callback is not None:
+            self.generation_callback(self)
 
-def simulate(i, individual, maps, ann, time, time_step, max_speed):
-    # Create new ann with same layers as before, but we will set new weights
-    net = Network(ann.get_layers())
-    net.set_weights(individual.weights)
+        self.write_run_log(best, avg, time.time() - t)
+
+        if self.curriculum is not None:
+            self.curriculum.update(self.generation_index, [g.raw_fitness for g in self.current_generation])
+
+        if self.checkpoint_interval > 0 and (self.generation_index + 1) % self.checkpoint_interval == 0:
+            self.save_checkpoint()
+
+    def write_run_log(self, best, avg, elapsed):
+        data = {
+            "generation": self.generation_index,
+            "best_fitness": best.fitness,
+            "avg_fitness": avg,
+            "avg_by_map": self.avg_by_map,
+            "num_simulations": self.num_simulations,
+            "episode_time": self.current_generation[0].episode_time,
+            "tasks": self.task_stats,
+            "elapsed_time": elapsed
+        }
+        with open(self.run_log_path, 'a') as outfile:
+            outfile.write(json.dumps(data) + "\n")
+
+    def save_checkpoint(self):
+        data = self.get_checkpoint_data()
+
+        # Written to a temporary file first, so a crash while writing
+        # doesn't destroy the last checkpoint
+        tmp = self.checkpoint_path[:-len(".npz")] + ".tmp.npz"
+        np.savez(tmp, **data)
+        os.replace(tmp, self.checkpoint_path)
+
+    # Arrays saved in the checkpoint, subclasses add their own state
+    def get_checkpoint_data(self):
+        population = self.current_generation
+        np_state = np.random.get_state()
+        # random.getstate() is (version, 624 Mersenne Twister words and the
+        # position, gauss_next or None)
+        (random_version, random_keys, random_gauss) = random.getstate()
+        data = {
+            "generation_index": self.generation_index,
+            "genomes": np.stack([ind.genome for ind in population]),
+            "fitness": np.array([ind.fitness for ind in population]),
+            "generations": np.array([ind.generation for ind in population]),
+            "map_index": np.array([ind.map_index for ind in population]),
+            # (individual, scenario, (map_index, pos_index, radius, vision, seed)),
+            # the seeds are below 2**32 and exact as floats
+            "scenarios": np.array([ind.scenarios for ind in population], dtype=float),
+            "avg_fitness": np.array(self.avg_fitness, dtype=float),
+            "avg_by_map": np.array(self.avg_by_map, dtype=float),
+            "best_genomes": np.stack([ind.genome for ind in self.best_in_generation]),
+            "best_fitness": np.array([ind.fitness for ind in self.best_in_generation]),
+            "best_generations": np.array([ind.generation for ind in self.best_in_generation]),
+            "elite_maps": np.array(list(self.elite_fitness.keys()), dtype=int),
+            "elite_fitness": np.array(list(self.elite_fitness.values()), dtype=float),
+            "random_version": random_version,
+            "random_keys": np.array(random_keys, dtype=np.uint32),
+            "random_gauss": np.array([random_gauss is not None, random_gauss or 0.0], dtype=float),
+            "np_random_keys": np_state[1],
+            "np_random_pos": np.array([np_state[2], np_state[3]]),
+            "np_random_gauss": np.array(np_state[4]),
+            "num_simulations": self.num_simulations
+        }
+        if self.curriculum is not None:
+            data["curriculum"] = self.curriculum.get_state()
+        return data
+
+    # Continues the run of a checkpoint, the ER has to be created with the
+    # same settings as the ER that wrote it
+    def resume(self, path=None):
+        if path is None:
+            path = self.checkpoint_path
+        if not os.path.exists(path):
+            print("No checkpoint at " + str(path) + "!")
+            sys.exit()
+
+        data = np.load(path)
+        self.load_checkpoint_data(data)
+
+        self.evaluated = True
+        print("Resumed from generation " + str(self.generation_index))
+
+    def load_checkpoint_data(self, data):
+        structure = self.ann.get_structure()
+        if data["genomes"].shape[1] != get_genome_size(structure):
+            print("The checkpoint doesn't match the structure of the ANN!")
+            sys.exit()
+
+        self.generation_index = int(data["generation_index"])
+        self.current_generation = self.create_individuals(data["genomes"], data["generations"].tolist())
+        for i, ind in enumerate(self.current_generation):
+            ind.fitness = float(data["fitness"][i])
+            ind.map_index = int(data["map_index"][i])
+            ind.scenarios = [(int(m), int(p), r, v, int(seed)) for (m, p, r, v, seed) in data["scenarios"][i].tolist()]
+
+        self.avg_fitness = data["avg_fitness"].tolist()
+        self.avg_by_map = data["avg_by_map"].tolist()
+        self.best_in_generation = self.create_individuals(data["best_genomes"], data["best_generations"].tolist())
+        for i, ind in enumerate(self.best_in_generation):
+            ind.fitness = float(data["best_fitness"][i])
+        self.elite_fitness = dict(zip(data["elite_maps"].tolist(), data["elite_fitness"].tolist()))
+
+        (has_gauss, gauss) = data["random_gauss"].tolist()
+        random.setstate((int(data["random_version"]), tuple(data["random_keys"].tolist()), gauss if has_gauss else None))
+        (pos, has_gauss) = data["np_random_pos"].tolist()
+        np.random.set_state(("MT19937", data["np_random_keys"], pos, has_gauss, float(data["np_random_gauss"])))
+        self.num_simulations = int(data["num_simulations"])
+        if self.curriculum is not None:
+            self.curriculum.set_state(data["curriculum"])
+
+
+    # Immigrants replace random children of the new generation
+    def insert_immigrants(self):
+        if len(self.immigrants) == 0:
+            return
+        immigrants = self.immigrants[:len(self.current_generation)]
+        self.immigrants = list()
+
+        replaced = random.sample(range(len(self.current_generation)), len(immigrants))
+        generation = self.current_generation[0].generation
+        for (i, genome) in zip(replaced, immigrants):
+            self.current_generation[i] = self.create_individuals([np.array(genome, dtype=float)], [generation])[0]
+        print("Immigrants: " + str(len(immigrants)))
+
+    def run_steady_state(self):
+        # There is no barrier at the end of a generation: every time a
+        # simulation finishes, its individual goes into the population and a
+        # child is bred from the population and simulated right away, so
+        # the workers never wait for the slowest simulation of a generation
+        results = queue.Queue()
+        initial = self.current_generation
+        self.current_generation = list()
+
+        running = dict() # task id -> individual
+        num_simulations = self.population_size * self.number_of_generations
+        started = 0
+        done = 0
+        t = time.time()
+
+        while done < num_simulations:
+            # Keep every worker busy, first with the initial population
+            # and then with children
+            while len(running) < self.processes and started < num_simulations:
+                if len(initial) > 0:
+                    ind = initial.pop(0)
+                elif len(self.current_generation) > 0:
+                    ind = self.breed()
+                else:
+                    break
+                self.start_simulation(started, ind, results)
+                running[started] = ind
+                started = started + 1
+
+            (task_id, summary, trajectory) = self.get_task_result(results)
+            ind = running.pop(task_id)
+            scenario = ind.scenarios[0]
+            ind.summaries = [summary]
+            ind.trajectories = [trajectory]
+            worst = min([g.fitness for g in self.current_generation], default=0)
+            ind.fitness = self.calculate_summary_fitness(summary, worst)
+            ind.raw_fitness = ind.fitness
+            ind.map_index = scenario[0]
+            self.insert(ind)
+            done = done + 1
+
+            if ind.fitness > self.elite_fitness.get(ind.map_index, -math.inf):
+                self.elite_fitness[ind.map_index] = ind.fitness
+
+            if done % self.population_size == 0:
+                print("Generation: " + str(self.generation_index))
+                print("Elapsed time: " + str(time.time() - t))
+                t = time.time()
+                avg = np.mean([g.fitness for g in self.current_generation])
+                self.avg_fitness.append(avg)
+
+                self.current_generation.sort(key=lambda x: x.fitness, reverse=True)
+                best = self.current_generation[0]
+                self.best_in_generation.append(best)
+                self.save_weights(best)
+                if self.fitness_cache is not None:
+                    self.fitness_cache.save()
+
+                print("Best fitness: " + str(best.fitness))
+                print("Average fitness: " + str(avg))
+                self.print_task_stats()
+                self.task_stats = self.get_empty_task_stats()
+                print("----------------")
+
+                if self.curriculum is not None:
+                    self.curriculum.update(self.generation_index, [g.raw_fitness for g in self.current_generation])
+
+                # Immigrants are simulated before the next children
+                if self.generation_callback is not None:
+                    self.generation_callback(self)
+                    if len(self.immigrants) > 0:
+                        initial.extend(self.create_individuals(self.immigrants, [self.generation_index + 1]*len(self.immigrants)))
+                        print("Immigrants: " + str(len(self.immigrants)))
+                    self.immigrants = list()
+                self.generation_index = self.generation_index + 1
+
+    def start_simulation(self, task_id, ind, results):
+        ind.scenarios = [create_scenario(self.maps)]
+        ind.episode_time = self.get_episode_time()
+        scenario = ind.scenarios[0]
+
+        if self.fitness_cache is not None:
+            summary = self.fitness_cache.get(FitnessCache.get_key(ind.genome, scenario, ind.episode_time))
+            if summary is not None:
+                self.in_flight[task_id] = [None, 0, None]
+                results.put((task_id, "ok", (summary, None)))
+                return
+
+        # The genome is always sent with the task, the rows of the shared
+        # population matrix don't belong to a fixed individual here
+        elite = self.get_task_elite(scenario)
+        self.num_simulations = self.num_simulations + 1
+        self.submit_task(task_id, (task_id, ind.genome, scenario, elite, ind.episode_time), results)
+
+    # A new individual replaces the worst one, if it is better
+    def insert(self, ind):
+        summary = ind.summaries[0]
+        if self.fitness_cache is not None and summary is not None and summary.get("stop_reason") != "fitness_bound":
+            self.fitness_cache.put(FitnessCache.get_key(ind.genome, ind.scenarios[0], ind.episode_time), ind.summaries[0])
+
+        if len(self.current_generation) < self.population_size:
+            self.current_generation.append(ind)
+            return
+        worst = min(range(len(self.current_generation)), key=lambda i: self.current_generation[i].fitness)
+        if ind.fitness > self.current_generation[worst].fitness:
+            self.current_generation[worst] = ind
+
+    # One child of two parents from the population, with the same
+    # selection, cross-over and mutation as reproduction
+    def breed(self):
+        parents = self.select_parents(2)
+        genomes = np.stack([p.genome for p in parents])
+        genomes = self.cross_over(genomes)
+        genomes = self.mutation(genomes)
+        generation = max([p.generation for p in parents]) + 1
+        return self.create_individuals(genomes[:1], [generation])[0]
+
+
+
+
+
+
+def init_worker(maps, structure, time_step, max_speed, raycast, return_trajectory=False, shared=None, stop_rules=None,
+                physics_step=1, continuous_collisions=False, skip_ahead=False):
+    if shared is not None:
+        maps = attach_shared_memory(shared)
+    worker["maps"] = maps
+    worker["structure"] = structure
+    worker["time_step"] = time_step
+    worker["max_speed"] = max_speed
+    worker["raycast"] = raycast
+    worker["return_trajectory"] = return_trajectory
+    worker["stop_rules"] = stop_rules
+    worker["physics_step"] = physics_step
+    worker["continuous_collisions"] = continuous_collisions
+    worker["skip_ahead"] = skip_ahead
+
+def attach_shared_memory(shared):
+    # Keep the SharedMemory objects alive as long as the worker lives
+    (name, size) = shared["genomes"]
+    worker["shm_genomes"] = shared_memory.SharedMemory(name=name)
+    worker["genomes"] = np.ndarray(size, dtype=np.float64, buffer=worker["shm_genomes"].buf)
+
+    (name, shape) = shared["walls"]
+    worker["shm_walls"] = shared_memory.SharedMemory(name=name)
+    walls = np.ndarray(shape, dtype=np.float64, buffer=worker["shm_walls"].buf)
+
+    maps = list()
+    for (start, end, start_points, index, sensor_table) in shared["maps"]:
+        maps.append(create_map(walls[start:end], start_points, index, sensor_table))
+    return maps
+
+def handle_timeout(signum, frame):
+    raise TimeoutError()
+
+# Runs simulate_task in a worker and reports how it went instead of raising:
+# (task_id, "ok", (summary, trajectory)), (task_id, "timeout", None) or
+# (task_id, "error", message). The timeout interrupts the simulation with
+# SIGALRM where it is available.
+def run_task(task_id, task, timeout=None):
+    alarm = timeout is not None and hasattr(signal, "SIGALRM")
+    if alarm:
+        signal.signal(signal.SIGALRM, handle_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        (i, scenario, summary, trajectory) = simulate_task(task)
+        return (task_id, "ok", (summary, trajectory))
+    except TimeoutError:
+        return (task_id, "timeout", None)
+    except Exception as e:
+        return (task_id, "error", repr(e))
+    finally:
+        if alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+def simulate_task(task):
+    (i, genome, scenario, elite, episode_time) = task
+    if genome is None:
+        # Row i of the shared population matrix
+        genome = worker["genomes"][i]
+
+    # Anything random in the simulation only depends on the scenario
+    seed = scenario[4]
+    random.seed(seed)
+    np.random.seed(seed)
+
+    agent = simulate(
+        split_genome(genome, worker["structure"]),
+        scenario,
+        worker["maps"],
+        worker["structure"],
+        episode_time,
+        worker["time_step"],
+        worker["max_speed"],
+        worker["raycast"],
+        worker["stop_rules"],
+        elite,
+        worker["physics_step"],
+        worker["continuous_collisions"],
+        worker["skip_ahead"]
+    )
+
+    # The whole agent (with its map, sensors and network) is not sent back,
+    # only the statistics and optionally the trajectory
+    trajectory = None
+    if worker["return_trajectory"]:
+        trajectory = np.array([agent.x_coord, agent.y_coord]).T
+    return (i, scenario, summarize_agent(agent), trajectory)
+
+def create_network(structure, weights):
+    layers = []
+    for s in structure:
+        layers.append(Dense(s[1], s[0]))
+    net = Network(layers)
+    net.set_weights(weights)
+    return net
+
+def simulate(weights, scenario, maps, structure, time, time_step, max_speed, raycast="numpy", stop_rules=None, elite_fitness=None,
+                physics_step=1, continuous_collisions=False, skip_ahead=False):
+    # Create new ann with the same structure, but we will set new weights
+    net = create_network(structure, weights)
     
     # We create an agent with the ann
-    agent = create_agent(maps, net, max_speed)
+    agent = create_agent(maps, net, max_speed, raycast, scenario, physics_step, continuous_collisions)
     
     # We run the simulation and receive back the updated agent
-    agent = create_simulation(agent, time, time_step)
-
-    individual.agent = agent
-    individual.map_index = agent.map["index"]
-
-    return individual
+    return create_simulation(agent, time, time_step, stop_rules, elite_fitness, physics_step, skip_ahead)
 
-def create_agent(maps,ann, max_speed):
+def create_scenario(maps, rng=random):
     # Random map from the pool
-    map_index = random.randint(0, len(maps)-1)
+    map_index = rng.randint(0, len(maps)-1)
     map = maps[map_index]
 
     # Random starting position on the map
-    pos_index = random.randint(0, len(map["start_points"])-1)
+    pos_index = rng.randint(0, len(map["start_points"])-1)
 
     # Random radius in range [30,70]
     radius_min = 20
     radius_max = 50
-    rnd_radius = random.uniform(radius_min, radius_max)
+    rnd_radius = rng.uniform(radius_min, radius_max)
 
     # Random vision distance
     vision_min = 50
     vision_max = 500
-    rnd_vision = random.uniform(vision_min, vision_max) 
+    rnd_vision = rng.uniform(vision_min, vision_max) 
+
+    # Seed of the random number generators during the simulation
+    seed = rng.randrange(2**32)
+
+    return (map_index, pos_index, rnd_radius, rnd_vision, seed)
+
+def create_agent(maps,ann, max_speed, raycast="numpy", scenario=None, physics_step=1, continuous_collisions=False):
+    if scenario is None:
+        scenario = create_scenario(maps)
+    (map_index, pos_index, rnd_radius, rnd_vision, seed) = scenario
+    map = maps[map_index]
 
     agent = Agent(
                     map = map,
@@ -420,17 +1200,24 @@ def create_agent(maps,ann, max_speed):
                     start_pos_index = pos_index,
                     max_vision = rnd_vision,
                     ann = ann,
-                    max_speed = max_speed
+                    max_speed = max_speed,
+                    raycast = raycast,
+                    physics_step = physics_step,
+                    continuous_collisions = continuous_collisions
                 )
     return agent
 
-def create_simulation(agent, time, time_step):
+def create_simulation(agent, time, time_step, stop_rules=None, elite_fitness=None, physics_step=1, skip_ahead=False):
     sim = Simulation(
         agent=agent, 
         render=False,
-        simulation=True,
+        headless=True, # fixed number of simulated ticks, not wall-clock time
         time=time, # how many seconds the simulation will run,
-        time_step=time_step # on how many ms should agent reevaluate motor speed
+        time_step=time_step, # on how many ms should agent reevaluate motor speed
+        stop_rules=stop_rules,
+        elite_fitness=elite_fitness,
+        physics_step=physics_step,
+        skip_ahead=skip_ahead
     )
     # simulate returns the agent object
     return sim.simulate()
@@ -466,6 +1253,10 @@ def main():
         mutation_prob = 0.05,
         max_abs_speed= 2.5
         )
+
+    # Continue a crashed run from the checkpoint in the weights folder
+    if "--resume" in sys.argv[3:]:
+        er.resume()
     er.run_er()
 
 
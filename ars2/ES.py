@@ -0,0 +1,154 @@
+import sys
+import os
+import numpy as np
+
+from ER import ER
+from ann import Dense, Network, get_genome_size
+from utils.map import get_maps
+
+
+# OpenAI-ES (Salimans et al. 2017) as an alternative to the genetic operators
+# of ER. Instead of a population of parents there is one mean genome; every
+# generation is the mean plus Gaussian noise, sampled in antithetic pairs
+# (mean + sigma*e, mean - sigma*e). After the generation is simulated, the
+# fitnesses are replaced by their centered ranks and the mean follows the
+# estimated gradient with Adam.
+#
+# Everything else (simulation, fitness, cache, scenarios, checkpoints, run
+# log) is the same as in ER, so run_er works the same way. Only the
+# generation callback isn't supported, see __init__.
+class ES(ER):
+    def __init__(self,
+                sigma = 0.02, # standard deviation of the noise
+                learning_rate = 0.01, # step size of Adam
+                weight_decay = 0.005, # pulls the mean towards 0
+                **kwargs # the settings of ER
+                ):
+        self.sigma = sigma
+        self.learning_rate = learning_rate
+        self.weight_decay = weight_decay
+
+        # Adam
+        self.beta1 = 0.9
+        self.beta2 = 0.999
+        self.epsilon = 1e-8
+        self.mean = None
+        self.m = None
+        self.v = None
+        self.t = 0
+
+        if kwargs.get("population_size", 10) % 2 != 0:
+            print("ES needs an even population size for the antithetic pairs!")
+            sys.exit()
+        if kwargs.get("steady_state", False):
+            print("ES can't be used for steady state evolution!")
+            sys.exit()
+        # The callback of ER is how immigrants (e.g. of an island model) get
+        # in, they aren't samples around the mean and would break the update
+        if kwargs.get("generation_callback") is not None:
+            print("ES can't take in immigrants from a generation callback!")
+            sys.exit()
+
+        super().__init__(**kwargs)
+
+    def initialize_population(self):
+        # Same initial weights as the ER
+        size = get_genome_size(self.ann.get_structure())
+        self.mean = np.random.uniform(-0.1, 0.1, size)
+        self.m = np.zeros(size)
+        self.v = np.zeros(size)
+        return self.sample_population(self.generation_index)
+
+    # Population of the given generation, every individual keeps its noise
+    # for the update of the mean
+    def sample_population(self, generation):
+        half = np.random.standard_normal((self.population_size // 2, len(self.mean)))
+        noise = np.concatenate((half, -half))
+        genomes = self.mean + self.sigma * noise
+        population = self.create_individuals(genomes, [generation]*self.population_size)
+        for (ind, e) in zip(population, noise):
+            ind.noise = e
+        return population
+
+    # Ranks scaled to [-0.5, 0.5], the best individual gets 0.5
+    def get_centered_ranks(self, fitness):
+        ranks = np.empty(len(fitness))
+        ranks[np.argsort(fitness, kind="stable")] = np.arange(len(fitness))
+        return ranks / (len(fitness) - 1) - 0.5
+
+    def reproduction(self):
+        # The population was sorted by find_best, the noise moved with the individuals
+        noise = np.stack([ind.noise for ind in self.current_generation])
+        fitness = np.array([ind.fitness for ind in self.current_generation])
+
+        shaped = self.get_centered_ranks(fitness)
+        gradient = shaped.dot(noise) / (len(noise) * self.sigma)
+        gradient = gradient - self.weight_decay * self.mean
+
+        # Adam, ascending the gradient
+        self.t = self.t + 1
+        self.m = self.beta1 * self.m + (1 - self.beta1) * gradient
+        self.v = self.beta2 * self.v + (1 - self.beta2) * gradient**2
+        m = self.m / (1 - self.beta1**self.t)
+        v = self.v / (1 - self.beta2**self.t)
+        self.mean = self.mean + self.learning_rate * m / (np.sqrt(v) + self.epsilon)
+
+        self.current_generation = self.sample_population(self.generation_index + 1)
+
+    def get_checkpoint_data(self):
+        data = super().get_checkpoint_data()
+        data["es_mean"] = self.mean
+        data["es_m"] = self.m
+        data["es_v"] = self.v
+        data["es_t"] = self.t
+        data["es_noise"] = np.stack([ind.noise for ind in self.current_generation])
+        return data
+
+    def load_checkpoint_data(self, data):
+        super().load_checkpoint_data(data)
+        self.mean = data["es_mean"]
+        self.m = data["es_m"]
+        self.v = data["es_v"]
+        self.t = int(data["es_t"])
+        for (ind, e) in zip(self.current_generation, data["es_noise"]):
+            ind.noise = e
+
+
+
+def main():
+    if len(sys.argv)<3:
+        print("Provide path to maps and weights!")
+        sys.exit()
+
+    map_dir = sys.argv[1]
+    maps = get_maps(map_dir)
+
+    weights_dir = os.path.abspath(sys.argv[2])
+
+
+    layers = [
+        Dense(16,4),
+        Dense(4,2)
+    ]
+    network = Network(layers)
+
+    es = ES(
+        maps = maps,
+        ann = network,
+        population_size = 40,
+        number_of_generations = 100,
+        time=10, # in s (this is the runtime of a single simulation of the agent)
+        time_step=10, #in ms
+        weights_dir = weights_dir,
+        max_abs_speed= 2.5,
+        scenarios_per_generation = 4 # the ranks only make sense if everybody is simulated in the same scenarios
+        )
+
+    # Continue a crashed run from the checkpoint in the weights folder
+    if "--resume" in sys.argv[3:]:
+        es.resume()
+    es.run_er()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import sys
+import os
+import argparse
+import queue
+import multiprocessing as mp
+from multiprocessing.managers import BaseManager
+
+from ER import ER
+from ann import Dense, Network
+from utils.map import get_maps
+
+
+# Island model of ER.
+# Every island is an ER population, in its own process and possibly on its own
+# machine, that evolves on its own subset of the maps. Every `interval`
+# generations an island sends the genomes of its best `size` individuals to
+# the next island (in a ring) and takes in the genomes it received, which
+# replace some of its children.
+#
+# The genomes are exchanged through queues served by a MigrationManager
+# (multiprocessing.managers), one inbox per island. The islands only talk to
+# the manager, so they can run on any machine that can reach it.
+
+
+# Inboxes of the islands, only used in the process of the manager server
+inboxes = {}
+
+def get_inbox(index):
+    if index not in inboxes:
+        inboxes[index] = queue.Queue()
+    return inboxes[index]
+
+class MigrationManager(BaseManager):
+    pass
+
+MigrationManager.register("get_inbox", callable=get_inbox)
+
+
+# Generation callback of an island's ER
+class Migration():
+    def __init__(self, index, num_islands, manager, interval=5, size=2):
+        self.index = index
+        self.interval = interval
+        self.size = size
+        self.inbox = manager.get_inbox(index)
+        self.outbox = manager.get_inbox((index + 1) % num_islands)
+
+    def __call__(self, er):
+        if (er.generation_index + 1) % self.interval != 0:
+            return
+
+        # The population is sorted by fitness when the callback is called
+        best = er.current_generation[:self.size]
+        self.outbox.put([ind.genome for ind in best])
+
+        # Whatever arrived so far, the islands don't wait for each other
+        while True:
+            try:
+                er.immigrants.extend(self.inbox.get_nowait())
+            except queue.Empty:
+                break
+
+
+def connect(address, authkey):
+    manager = MigrationManager(address=address, authkey=authkey)
+    manager.connect()
+    return manager
+
+# Maps of an island, the maps are dealt out to the islands like cards.
+# With fewer maps than islands every island gets all the maps.
+def get_island_maps(maps, index, num_islands):
+    if len(maps) < num_islands:
+        return maps
+    return maps[index::num_islands]
+
+def run_island(index, num_islands, address, authkey, map_dir, weights_dir, interval, size, er_args):
+    maps = get_island_maps(get_maps(map_dir), index, num_islands)
+
+    weights_dir = os.path.join(weights_dir, "island_" + str(index))
+    os.makedirs(weights_dir, exist_ok=True)
+
+    manager = connect(address, authkey)
+
+    layers = [
+        Dense(16,4),
+        Dense(4,2)
+    ]
+    er = ER(
+        maps = maps,
+        ann = Network(layers),
+        weights_dir = weights_dir,
+        generation_callback = Migration(index, num_islands, manager, interval, size),
+        **er_args
+    )
+    er.run_er()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run ER as an island model.')
+    parser.add_argument('maps', help='Path to the maps.')
+    parser.add_argument('weights', help='Path to the weights folder, every island writes into its own subfolder.')
+    parser.add_argument('--islands', action='store', default=2, type=int,
+                        help='Number of islands. Default is 2.')
+    parser.add_argument('--island', action='store', default=None, type=int,
+                        help='Only run this island, connecting to the manager at --host.')
+    parser.add_argument('--serve', action=argparse.BooleanOptionalAction, default=False,
+                        help='Only run the manager the islands connect to.')
+    parser.add_argument('--host', action='store', default='127.0.0.1',
+                        help='Address of the manager. Default is 127.0.0.1.')
+    parser.add_argument('--port', action='store', default=50000, type=int,
+                        help='Port of the manager. Default is 50000.')
+    parser.add_argument('--authkey', action='store', default='ars',
+                        help='Shared secret of the manager and the islands.')
+    parser.add_argument('--interval', action='store', default=5, type=int,
+                        help='Migrate every this many generations. Default is 5.')
+    parser.add_argument('--size', action='store', default=2, type=int,
+                        help='Number of genomes sent to the next island. Default is 2.')
+    parser.add_argument('--processes', action='store', default=None, type=int,
+                        help='Worker processes per island. By default the CPU cores are split between the local islands.')
+    parser.add_argument('--population', action='store', default=40, type=int,
+                        help='Population size of every island. Default is 40.')
+    parser.add_argument('--generations', action='store', default=100, type=int,
+                        help='Number of generations. Default is 100.')
+    args = parser.parse_args()
+
+    address = (args.host, args.port)
+    authkey = args.authkey.encode()
+    weights_dir = os.path.abspath(args.weights)
+
+    if args.serve:
+        manager = MigrationManager(address=address, authkey=authkey)
+        print("Serving the island inboxes on " + str(address))
+        manager.get_server().serve_forever()
+        return
+
+    local_islands = range(args.islands)
+    if args.island is not None:
+        local_islands = [args.island]
+
+    processes = args.processes
+    if processes is None:
+        processes = max(mp.cpu_count() // len(local_islands), 1)
+
+    er_args = {
+        "population_size": args.population,
+        "number_of_generations": args.generations,
+        "time": 10,
+        "time_step": 10,
+        "cross_over_prob": 0.9,
+        "mutation_prob": 0.05,
+        "max_abs_speed": 2.5,
+        "processes": processes
+    }
+
+    manager = None
+    if args.island is None:
+        # Everything on this machine, the manager runs in its own process
+        manager = MigrationManager(address=address, authkey=authkey)
+        manager.start()
+
+    islands = list()
+    for i in local_islands:
+        p = mp.Process(target=run_island, args=(i, args.islands, address, authkey, args.maps,
+                                                weights_dir, args.interval, args.size, er_args))
+        p.start()
+        islands.append(p)
+
+    for p in islands:
+        p.join()
+
+    if manager is not None:
+        manager.shutdown()
+
+    if any([p.exitcode != 0 for p in islands]):
+        print("Not all islands finished!")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,9 @@ from utils.agent import Agent
 from utils.map import read_map
 from ann import Dense, Network, get_network
 
+# Simulated ms per loop of a headless simulation
+TICK_MS = 10
+
 class Settings:
     def __init__(self, w=1024, h=1024, margin=0):
         self.BOARD_WIDTH = w
@@ -38,6 +41,12 @@ class Simulation():
                         time_tick = 100,
                         time_s = 0.1,
                         sensors = True,
+                        headless = False,
+                        stop_rules = None, # rules to stop a headless simulation early, see early_stop.py
+                        elite_fitness = None, # fitness the episode has to be able to beat, used by the stop rules
+                        physics_step = 1, # ticks simulated per update of the agent, see MotionModel
+                        continuous_collisions = False, # stop the agent where it first touches a wall, needed for large physics steps
+                        skip_ahead = False # plan the updates between two runs of the ANN when no wall is within reach, see Agent.plan_updates
                         ):
         self.map = map
         self.sett = Settings()
@@ -53,6 +62,25 @@ class Simulation():
 
         self.sensors = sensors
 
+        # Headless runs a fixed number of simulated ticks as fast as possible,
+        # without the pygame clock, events or rendering. The simulated time
+        # is then independent of the wall clock.
+        self.headless = headless
+        if self.headless:
+            self.render = False
+
+        # Simulated ms per loop and the simulated time so far (in s)
+        self.physics_step = physics_step
+        self.continuous_collisions = continuous_collisions
+        self.tick_ms = TICK_MS * physics_step
+        self.skip_ahead = skip_ahead
+        self.sim_time = 0
+
+        self.stop_rules = stop_rules
+        if self.stop_rules is None:
+            self.stop_rules = []
+        self.elite_fitness = elite_fitness
+
         # Vision/Speed/Radius properties of an agent
         self.max_vision = max_vision
         self.max_speed = max_speed
@@ -73,9 +101,9 @@ class Simulation():
             self.setup_agent()
 
 
-        self.clock = pygame.time.Clock()
-
-        pygame.init()
+        if not self.headless:
+            self.clock = pygame.time.Clock()
+            pygame.init()
 
         if self.render:
             pygame.font.init()
@@ -99,10 +127,31 @@ class Simulation():
                         localization = self.localization,
                         time_step = self.time_step,
                         speed_increment=self.speed_increment,
-                        time_s = self.time_s
+                        time_s = self.time_s,
+                        physics_step = self.physics_step,
+                        continuous_collisions = self.continuous_collisions
                     )
 
     def simulate(self):
+        if self.headless:
+            if self.time == None or self.time == math.inf:
+                print("Headless simulation needs a finite time!")
+                sys.exit()
+            for r in self.stop_rules:
+                r.reset(self)
+            num_ticks = self.get_num_ticks()
+            for i in range(num_ticks - 1):
+                self.loop()
+                rule = self.check_stop_rules(i + 1)
+                if rule is not None:
+                    # The rest of the episode is extrapolated, not simulated
+                    self.agent.extrapolate(num_ticks - i - 1, rule.name)
+                    return self.agent
+            # The last tick, nothing left to save after it
+            if num_ticks > 0:
+                self.loop()
+            return self.agent
+
         if self.time == None:
             while 1:
                 self.loop()
@@ -113,6 +162,16 @@ class Simulation():
 
         return self.agent
 
+    # First rule that wants to stop the episode after the given tick, or None
+    def check_stop_rules(self, tick):
+        for r in self.stop_rules:
+            if r.should_stop(self, tick):
+                return r
+        return None
+
+    def get_num_ticks(self):
+        return int(round(self.time * 1000 / self.tick_ms))
+
     def eventLoop(self):
         for event in pygame.event.get():
             if event.type == QUIT:
@@ -132,9 +191,12 @@ class Simulation():
     def simulationEventLoop(self):
         # Update motor values from ANN
         # This has to be done every time step
-        if self.counter == self.time_step:
+        if self.counter >= self.time_step:
             self.agent.ann_controller_run()
             self.counter = 0
+            if self.skip_ahead:
+                # Updates until the ANN runs again
+                self.agent.plan_updates(math.ceil(self.time_step/self.tick_ms))
         self.agent.update()
 
 
@@ -145,12 +207,14 @@ class Simulation():
         else:
             self.simulationEventLoop()
 
-        self.tick()
+        if not self.headless:
+            self.tick()
         if self.render:
             self.draw()
             pygame.display.update()
 
-        self.counter = self.counter + 10
+        self.counter = self.counter + self.tick_ms
+        self.sim_time = self.sim_time + self.tick_ms/1000
 
     # This part is taken from https://stackoverflow.com/questions/65767785/how-to-draw-a-rotated-ellipse-using-pygame
     # This is to draw a rotate ellipse in pygame. In our case to display the covariance matrix
@@ -304,6 +368,14 @@ def main():
     parser.add_argument('--sensors', action=argparse.BooleanOptionalAction, 
                         default=True,
                         help='Enable/Disable sensors'),                           
+    parser.add_argument('--headless', action=argparse.BooleanOptionalAction, 
+                        default=False,
+                        help='Run --time simulated seconds as fast as possible, without rendering.'),
+    parser.add_argument('--physics_step', action='store', default=1, type=int,
+                        help='Number of 10ms ticks simulated per update of the agent. Default is 1.'),
+    parser.add_argument('--continuous', action=argparse.BooleanOptionalAction,
+                        default=False,
+                        help='Continuous collision detection, keeps the agent inside the map with large physics steps.'),
     args = parser.parse_args()
 
 
@@ -325,7 +397,9 @@ def main():
                     time_step = time_step,
                     time_s = perc,
                     speed_increment=args.speed_increment,
-                    sensors = args.sensors
+                    sensors = args.sensors,
+                    physics_step = args.physics_step,
+                    continuous_collisions = args.continuous
         )
 
 
@@ -341,7 +415,10 @@ def main():
                     time = args.time,
                     time_s = perc,
                     speed_increment = args.speed_increment,
-                    sensors = args.sensors
+                    sensors = args.sensors,
+                    headless = args.headless,
+                    physics_step = args.physics_step,
+                    continuous_collisions = args.continuous
                     )
     ui.simulate()
 
@@ -20,7 +20,7 @@ class Dense:
         self.output = np.add(self.output, self.bias)
 
         # apply activation
-        self.output = np.array([self.sigmoid(o) for o in self.output])
+        self.output = self.sigmoid(self.output)
 
         return self.output
     
@@ -74,6 +74,83 @@ class Network:
 
 
 
+# Runs the same network structure for a whole population at once.
+# The weights of the P individuals are stacked as one (P, output, input)
+# array per layer and the inputs are (P, n_sensors), so every layer is a
+# single einsum for all individuals. Like Network, the first layer also gets
+# its own previous output as input, which is kept in a preallocated buffer.
+class PopulationNetwork:
+    def __init__(self, structure, population_size):
+        self.structure = [tuple(s) for s in structure]
+        self.population_size = population_size
+
+        self.weights = None
+        self.bias = [np.ones(s[0]) for s in self.structure]
+
+        # Input of the first layer: [sensor values, previous output]
+        self.input = np.zeros((population_size, self.structure[0][1]))
+        self.prev_output = np.zeros((population_size, self.structure[0][0]))
+        self.outputs = [np.zeros((population_size, s[0])) for s in self.structure]
+
+    def set_weights(self, weights):
+        for i in range(len(self.structure)):
+            if weights[i].shape != (self.population_size,) + self.structure[i]:
+                print("Error! Shape of weights is wrong!")
+                sys.exit()
+        self.weights = weights
+
+    # (P, genome_size) matrix of genomes, see split_genome
+    def set_genomes(self, genomes):
+        self.set_weights(split_genome(genomes, self.structure))
+
+    def reset(self):
+        self.prev_output[:] = 0
+
+    def sigmoid(self, x):
+        # In place version of Dense.sigmoid
+        np.negative(x, out=x)
+        np.exp(x, out=x)
+        np.add(x, 1, out=x)
+        np.reciprocal(x, out=x)
+        np.clip(x, 0.0000001, 0.9999999, out=x)
+        return x
+
+    def run_network(self, sensor_values):
+        n = sensor_values.shape[1]
+        self.input[:, :n] = sensor_values
+        self.input[:, n:] = self.prev_output
+
+        output = self.input
+        for i in range(len(self.structure)):
+            out = self.outputs[i]
+            np.einsum("poi,pi->po", self.weights[i], output, out=out)
+            np.add(out, self.bias[i], out=out)
+            output = self.sigmoid(out)
+
+        self.prev_output[:] = self.outputs[0]
+        return output
+
+
+# A genome holds the weights of all the layers of a network as one flat
+# vector, layer after layer, every layer in row-major (output, input) order.
+def get_genome_size(structure):
+    size = 0
+    for s in structure:
+        size = size + s[0]*s[1]
+    return size
+
+# Returns the weights of every layer as reshaped views into the genome.
+# For a (P, genome_size) matrix of genomes the views are (P, output, input).
+def split_genome(genome, structure):
+    weights = []
+    start = 0
+    for s in structure:
+        end = start + s[0]*s[1]
+        w = genome[..., start:end]
+        weights.append(w.reshape(genome.shape[:-1] + tuple(s)))
+        start = end
+    return weights
+
 
 def get_network(weights_path):
     f = open(weights_path, 'r')
@@ -81,7 +158,10 @@ def get_network(weights_path):
 
     # Create the agent with the specified ann
     net_struct = js['nn_structure']
-    weights = json.loads(js['weights'])
+    # Older files have the weights json encoded a second time
+    weights = js['weights']
+    if isinstance(weights, str):
+        weights = json.loads(weights)
 
     layers = []
     W = []
@@ -0,0 +1,65 @@
+import numpy as np
+
+
+# Episode length curriculum for ER.
+# Early controllers crash within the first second, so simulating them for the
+# full time is mostly wasted. The curriculum starts with short episodes and
+# makes them longer, either on a fixed schedule or when the population gets
+# better, until they reach max_time.
+#
+# schedule: list of (generation, time), from that generation on the episodes
+#           last time seconds, e.g. [(0, 2), (10, 5), (30, 10)]
+# Without a schedule the episodes start at min_time and grow by the factor
+# growth whenever the median fitness of a generation is `improvement` better
+# than at the start of the current length, or after `patience` generations.
+class Curriculum():
+    def __init__(self, max_time, min_time=1, schedule=None, growth=2.0, improvement=0.2, patience=10):
+        self.max_time = max_time
+        self.min_time = min(min_time, max_time)
+        self.schedule = schedule
+        if self.schedule is not None:
+            self.schedule = sorted(schedule)
+        self.growth = growth
+        self.improvement = improvement
+        self.patience = patience
+
+        self.time = self.min_time
+        self.stage_fitness = None # median fitness in the first generation of the current length
+        self.stage_generations = 0 # generations at the current length
+
+    # Length of the episodes (in s) of the generation
+    def get_time(self, generation_index):
+        if self.schedule is None:
+            return self.time
+        time = self.schedule[0][1]
+        for (generation, t) in self.schedule:
+            if generation <= generation_index:
+                time = t
+        return min(time, self.max_time)
+
+    # Called after a generation was evaluated with its fitness
+    def update(self, generation_index, fitness):
+        if self.schedule is not None or self.time >= self.max_time:
+            return
+
+        median = float(np.median(fitness))
+        self.stage_generations = self.stage_generations + 1
+        if self.stage_fitness is None:
+            self.stage_fitness = median
+            return
+
+        improved = median > self.stage_fitness + self.improvement * abs(self.stage_fitness)
+        if improved or self.stage_generations >= self.patience:
+            self.time = min(self.time * self.growth, self.max_time)
+            self.stage_fitness = None
+            self.stage_generations = 0
+
+    # State saved in the checkpoints of ER
+    def get_state(self):
+        stage_fitness = np.nan if self.stage_fitness is None else self.stage_fitness
+        return np.array([self.time, stage_fitness, self.stage_generations])
+
+    def set_state(self, state):
+        (self.time, stage_fitness, stage_generations) = state.tolist()
+        self.stage_fitness = None if np.isnan(stage_fitness) else stage_fitness
+        self.stage_generations = int(stage_generations)
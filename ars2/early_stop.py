@@ -0,0 +1,75 @@
+from fitness import summarize_agent, fitness_upper_bound
+
+
+# Rules to stop a headless simulation early, when the episode can't end well
+# anymore. They are checked by the Simulation after every tick.
+#
+# When a rule stops the episode, the agent is frozen in place for the rest of
+# the episode: the statistics of its last tick are repeated for the remaining
+# ticks (see Agent.extrapolate), so the summary and the fitness have the same
+# meaning as those of a full episode.
+#
+# A rule has a name, which ends up in the summary of a stopped episode,
+# reset(sim) which is called before the episode starts and
+# should_stop(sim, tick) which is called after every tick.
+
+
+# A corner collision already multiplies the fitness by 0.00001
+class CornerCollisionRule():
+    name = "corner_collision"
+
+    def reset(self, sim):
+        pass
+
+    def should_stop(self, sim, tick):
+        return sim.agent.num_of_corner_collisions > 0
+
+
+# The agent didn't move for the last `ticks` ticks
+class StuckRule():
+    name = "stuck"
+
+    def __init__(self, ticks=200):
+        self.ticks = ticks
+
+    def reset(self, sim):
+        self.position = None
+        self.count = 0
+
+    def should_stop(self, sim, tick):
+        p = sim.agent.position
+        position = (p.X, p.Y)
+        if position == self.position:
+            self.count = self.count + 1
+        else:
+            self.count = 0
+        self.position = position
+        return self.count >= self.ticks
+
+
+# Even the best possible rest of the episode can't beat the elite.
+# The elite is the fitness given to the Simulation as elite_fitness, without
+# one the rule never stops an episode.
+class FitnessBoundRule():
+    name = "fitness_bound"
+
+    def __init__(self, check_every=100):
+        self.check_every = check_every
+
+    def reset(self, sim):
+        walls = sim.agent.map["grid"].walls
+        xs = walls[:, [0, 2]]
+        ys = walls[:, [1, 3]]
+        # Largest x*y over the bounding box of the map
+        corners = [(x, y) for x in (xs.min(), xs.max()) for y in (ys.min(), ys.max())]
+        self.max_xy = max([x*y for (x, y) in corners] + [0])
+
+    def should_stop(self, sim, tick):
+        if sim.elite_fitness is None or tick % self.check_every != 0:
+            return False
+        agent = sim.agent
+        remaining = sim.get_num_ticks() - tick
+        bound = fitness_upper_bound(summarize_agent(agent), remaining,
+                                    agent.sensor_model.num_sensors, self.max_xy,
+                                    agent.x_coord[0]*agent.y_coord[0])
+        return bound < sim.elite_fitness
@@ -0,0 +1,119 @@
+import numpy as np
+
+
+# The fitness of an agent only depends on a handful of statistics collected
+# during the simulation. They are gathered in a summary (a dict), so the
+# fitness can be computed the same way for a simulated Agent object and for
+# the agents of a batched simulation.
+
+
+# Same as np.trapz(y=y, x=x) + np.trapz(y=x, x=y)
+def trajectory_area(x, y):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    dx = np.diff(x)
+    dy = np.diff(y)
+    areax = np.sum(dx * (y[1:] + y[:-1])) / 2
+    areay = np.sum(dy * (x[1:] + x[:-1])) / 2
+    return areax + areay
+
+
+def summarize_agent(agent):
+    return {
+        "area": trajectory_area(agent.x_coord, agent.y_coord),
+        "num_of_collisions": agent.num_of_collisions,
+        "num_of_corner_collisions": agent.num_of_corner_collisions,
+        "num_agent_updates": agent.num_agent_updates,
+        "counted_sensors": agent.counted_sensors,
+        "close_to_wall": agent.close_to_wall,
+        "far_from_wall": agent.far_from_wall,
+        "min_distance": agent.min_distance,
+        "avg_sensor_distance": agent.avg_sensor_distance,
+        "max_vision": agent.max_vision,
+        "skipped_updates": agent.skipped_updates, # updates not simulated because the episode was stopped early
+        "stop_reason": agent.stop_reason
+    }
+
+
+# The fitness doesn't grow with the length of the episode: the area only
+# depends on the first and the last position (see fitness_upper_bound), the
+# other terms are averages or ratios. So the fitness of episodes of different
+# lengths can be compared as it is.
+def calculate_fitness(summary):
+    # Fitness function based on the data the agent has collected
+
+    # Area
+    A = summary["area"]
+
+    # Punishment collisions
+    col = summary["num_of_collisions"]
+    upd = summary["num_agent_updates"]
+    if upd == 0:
+        upd = 1
+    P = col/upd
+    if col>0:
+        P = 0.95
+
+    # Penalty for colliding into a corner
+    corner_penalty = 1.0
+    if(summary["num_of_corner_collisions"] > 0):
+        corner_penalty = 0.00001
+
+    counted_sensors = summary["counted_sensors"]
+    if counted_sensors == 0:
+        counted_sensors = 1
+
+    # Reward for large  min_distance
+    min_penalty = (summary["min_distance"]/summary["max_vision"])
+
+    # Punishment for amount of time being too close to the walls
+    close_penalty = (summary["close_to_wall"]/counted_sensors)**2
+
+    # Reward for amount of time being a good distance from the walls
+    far_reward = (summary["far_from_wall"]/counted_sensors)**2
+
+    # A medium-high sensor distance average is good, low is bad
+    avg_sensor_dist = (summary["avg_sensor_distance"]/upd)
+
+    F = 0.0001*A*(1-P)*corner_penalty*avg_sensor_dist*1000*far_reward*500*(1-close_penalty)*min_penalty
+    return F
+
+
+# Upper bound of the fitness an agent can still reach, given the summary of
+# the episode so far and the number of remaining updates.
+# The area only depends on the first and the last position of the trajectory,
+# max_xy is the largest x*y the agent can end at and first_xy is x*y of the
+# first position.
+def fitness_upper_bound(summary, remaining, num_sensors, max_xy, first_xy):
+    A = max_xy - first_xy
+    if A <= 0:
+        # All the other terms are positive
+        return 0
+
+    # Collisions and corner collisions only get worse
+    P = 0
+    if summary["num_of_collisions"] > 0:
+        P = 0.95
+    corner_penalty = 1.0
+    if summary["num_of_corner_collisions"] > 0:
+        corner_penalty = 0.00001
+
+    # In the best case all the remaining sensor readings are far from the walls
+    k = remaining*num_sensors
+    counted_sensors = summary["counted_sensors"] + k
+    if counted_sensors == 0:
+        counted_sensors = 1
+    far_reward = ((summary["far_from_wall"] + k)/counted_sensors)**2
+    close_penalty = (summary["close_to_wall"]/counted_sensors)**2
+
+    # The min distance only gets smaller
+    min_penalty = summary["min_distance"]/summary["max_vision"]
+
+    # A reading is at most max vision, rounded to 0.1
+    upd = summary["num_agent_updates"] + remaining
+    if upd == 0:
+        upd = 1
+    max_reading = (summary["max_vision"] + 0.05)/summary["max_vision"]
+    avg_sensor_dist = (summary["avg_sensor_distance"] + remaining*max_reading)/upd
+
+    return 0.0001*A*(1-P)*corner_penalty*avg_sensor_dist*1000*far_reward*500*(1-close_penalty)*min_penalty
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Cache of simulation results.
+# With the same simulation settings (maps, ANN structure, time step, speed,
+# raycasting, physics, stop rules), a simulation is determined by the
+# genome, the scenario (map index, start point, radius, vision, seed) and the
+# length of the episode. The summary of a simulation can be reused for any
+# individual with the same genome that is simulated in the same scenario for
+# as long, e.g. individuals that went through reproduction without
+# cross-over or mutation.
+#
+# The cache keeps at most max_size summaries and drops the least recently
+# used ones. With a path the cache is loaded from and saved to a json file,
+# so it survives between runs. The file also holds the settings (a
+# fingerprint string, see ER.get_settings_fingerprint) it was written with,
+# a file written with other settings is dropped.
+class FitnessCache():
+    def __init__(self, max_size=100000, path=None, settings=None):
+        self.max_size = max_size
+        self.path = path
+        self.settings = settings
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+        if self.path is not None and os.path.exists(self.path):
+            self.load()
+
+    @staticmethod
+    def get_key(genome, scenario, time):
+        genome = np.ascontiguousarray(genome, dtype=np.float64)
+        h = hashlib.sha1(genome.tobytes()).hexdigest()
+        (map_index, pos_index, radius, vision, seed) = scenario
+        return (h, int(map_index), int(pos_index), float(radius), float(vision), int(seed), float(time))
+
+    # Summary stored for the key or None
+    def get(self, key):
+        summary = self.entries.get(key)
+        if summary is None:
+            self.misses = self.misses + 1
+            return None
+        self.hits = self.hits + 1
+        self.entries.move_to_end(key)
+        return summary
+
+    def put(self, key, summary):
+        self.entries[key] = summary
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get_hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0
+        return self.hits/total
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        if not isinstance(data, dict) or data.get("settings") != self.settings:
+            print("Fitness cache " + self.path + " was written with other simulation settings, dropping it!")
+            os.remove(self.path)
+            return
+        for (key, summary) in data["entries"]:
+            self.put(tuple(key), summary)
+
+    def save(self):
+        if self.path is None:
+            return
+        # Least recently used first, so the order survives a reload
+        entries = [[list(key), summary] for (key, summary) in self.entries.items()]
+        data = {"settings": self.settings, "entries": entries}
+
+        # Written to a temporary file first, so an interrupted run
+        # doesn't leave a broken cache behind
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as outfile:
+            json.dump(data, outfile)
+        os.replace(tmp, self.path)
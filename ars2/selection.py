@@ -0,0 +1,62 @@
+import numpy as np
+
+
+# Selection operators. Each one draws all the parents of a generation at once
+# and returns their indices in the population, given the fitness of every
+# individual as an array. Higher fitness is better.
+
+
+# Fitness proportionate selection. Negative fitness counts as 0, if nobody
+# has a positive fitness the parents are drawn uniformly.
+def roulette_wheel_selection(fitness, n):
+    fitness = np.maximum(np.asarray(fitness, dtype=float), 0)
+    wheel = np.cumsum(fitness)
+    total = wheel[-1]
+    if not total > 0:
+        return np.random.randint(0, len(fitness), n)
+    picks = np.random.uniform(0, total, n)
+    # First individual whose part of the wheel ends after the pick
+    return np.minimum(np.searchsorted(wheel, picks, side="right"), len(fitness) - 1)
+
+
+# Fitness proportionate like the roulette wheel, but with n evenly spaced
+# pointers and a single random offset, so an individual is picked close to
+# the number of times its share of the wheel says.
+# The pointers pick the individuals in population order, the picks are
+# shuffled so consecutive parents (the pairs of the cross-over) aren't the
+# same or neighbouring individuals.
+def stochastic_universal_sampling(fitness, n):
+    fitness = np.maximum(np.asarray(fitness, dtype=float), 0)
+    wheel = np.cumsum(fitness)
+    total = wheel[-1]
+    if not total > 0:
+        return np.random.randint(0, len(fitness), n)
+    step = total / n
+    pointers = np.random.uniform(0, step) + step * np.arange(n)
+    picks = np.minimum(np.searchsorted(wheel, pointers, side="right"), len(fitness) - 1)
+    return picks[np.random.permutation(n)]
+
+
+# Best of k random individuals, n times. The first of equally fit contestants wins.
+def tournament_selection(fitness, n, k=7):
+    fitness = np.asarray(fitness, dtype=float)
+    contestants = np.random.randint(0, len(fitness), (n, k))
+    winner = np.argmax(fitness[contestants], axis=1)
+    return contestants[np.arange(n), winner]
+
+
+# Roulette wheel on the ranks: the worst individual has rank 1, the best rank
+# len(fitness), so the scale of the fitness doesn't matter
+def rank_selection(fitness, n):
+    fitness = np.asarray(fitness, dtype=float)
+    ranks = np.empty(len(fitness))
+    ranks[np.argsort(fitness, kind="stable")] = np.arange(1, len(fitness) + 1)
+    return roulette_wheel_selection(ranks, n)
+
+
+selection_methods = {
+    "roulette": roulette_wheel_selection,
+    "sus": stochastic_universal_sampling,
+    "tournament": tournament_selection,
+    "rank": rank_selection
+}
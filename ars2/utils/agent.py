@@ -2,7 +2,9 @@ import math
 import numpy as np
 
 from utils.motion_model import MotionModel
+from utils.kinematics import differential_drive
 from utils.sensor_model import SensorModel
+from utils.sensor_table import load_sensor_table
 
 from utils.object import Object
 from utils.vector import Vector, Point
@@ -15,7 +17,8 @@ class Agent():
     def __init__(self,  map = None, radius = 50, start_pos_index = None, 
                         max_vision=100, ann = None, max_speed = 2.0,
                         localization=False, time_step=100, time_s=0.1,
-                        speed_increment = 0.5
+                        speed_increment = 0.5, raycast="numpy",
+                        physics_step = 1, continuous_collisions = False
                 ):
         if map == None or radius == None or start_pos_index == None:
             print("SPECIFY MAP, RADIUS AND START_POS_INDEX FOR AGENT!")
@@ -34,9 +37,19 @@ class Agent():
 
         self.map = map
 
-        self.motion_model = MotionModel(self.radius * 2, self.map["map"], self.max_speed)
+        grid = self.map.get("grid")
+        table = None
+        if raycast == "table":
+            if self.map.get("sensor_table") is None:
+                print("No sensor table was built for map " + str(self.map["index"]) + "!")
+                sys.exit()
+            table = load_sensor_table(self.map["sensor_table"])
+
+        self.motion_model = MotionModel(self.radius * 2, self.map["map"], self.max_speed, grid,
+                                        step=physics_step, continuous=continuous_collisions)
         self.sensor_model = SensorModel(self.position, self.theta, self.radius,
-                                        self.map["map"],12,self.max_vision)
+                                        self.map["map"],12,self.max_vision,
+                                        raycast=raycast, grid=grid, table=table)
 
         # Radius Bound is a horizontal vector
         self.circleObject = Object(self.position, [Vector(Point(0, 0), Point(self.radius, 0))], type="circle")
@@ -93,6 +106,15 @@ class Agent():
 
         self.min_distance = 100000
 
+        # Statistics the last update added, repeated by extrapolate
+        self.last_update_data = (False, False, 0, 0, 0, 0)
+        # Updates that weren't simulated because the episode was stopped early
+        self.skipped_updates = 0
+        self.stop_reason = None
+
+        # Poses and sensor readings of the next updates, see plan_updates
+        self.planned = []
+
     def get_coordinates(self):
         return (self.x_coord, self.y_coord)
 
@@ -188,30 +210,89 @@ class Agent():
         good_distance = 0.5*self.max_vision
         bad_distance = 0.3*self.max_vision
 
+        counted = 0
+        far = 0
+        close = 0
         for d in sensor_distances:    
             if d < 0:
                 continue
             if d < self.min_distance:
                 self.min_distance = d
-            self.counted_sensors = self.counted_sensors + 1
+            counted = counted + 1
             if d >= good_distance:
-                self.far_from_wall = self.far_from_wall + 1
+                far = far + 1
             if d < bad_distance:
-                self.close_to_wall = self.close_to_wall + 1
+                close = close + 1
 
             v = (d/self.max_vision)
             sum_distances = sum_distances + v
             i = i + 1
         
+        self.counted_sensors = self.counted_sensors + counted
+        self.far_from_wall = self.far_from_wall + far
+        self.close_to_wall = self.close_to_wall + close
+
         if i==0:
             i = 1
             
         self.avg_sensor_distance = self.avg_sensor_distance + (sum_distances/i)
 
+        self.last_update_data = (is_colliding, is_colliding_corner, counted, far, close, sum_distances/i)
+
+
+    # Event-driven stepping. The speeds stay the same for the next n updates
+    # (until the ANN runs again), so if no wall is within reach of the agent
+    # in that time it can't collide and its poses are known in advance.
+    # The sensors are then read at all of them at once and the updates only
+    # apply the planned pose and readings, the statistics stay the same as
+    # with stepping tick by tick.
+    def plan_updates(self, n):
+        self.planned = []
+        mm = self.motion_model
+        if n < 2 or not mm.is_moving() or self.localization is not None or self.sensor_model.raycast == "shapely":
+            return
+
+        reach = abs(mm.vl + mm.vr)/2 * mm.step * n
+        clearance = mm.collision_detection.get_clearance(self.position.X, self.position.Y, reach, self.map["map"])
+        # With some margin for the rounding of the poses
+        if clearance <= reach + 1e-6:
+            return
+
+        poses = []
+        (x, y, theta) = (self.position.X, self.position.Y, self.theta)
+        for i in range(n):
+            (x, y, theta) = differential_drive(x, y, theta, mm.vl, mm.vr, mm.l, mm.step)
+            poses.append((x, y, theta))
+        readings = self.sensor_model.get_readings(poses)
+
+        # Popped from the end
+        self.planned = list(zip(poses, readings))[::-1]
+
+    # Same as update when the motion model finds no collision
+    def update_planned(self):
+        ((x, y, new_theta), reading) = self.planned.pop()
+        new_position = Point(x, y)
+
+        mm = self.motion_model
+        mm.is_colliding = False
+        mm.is_colliding2 = False
+        mm.collisions = []
+
+        self.update_agent_objects(new_position, new_theta)
+        self.sensor_model.set_readings(new_position, new_theta, reading)
+
+        self.theta = new_theta
+        self.position = new_position
+
+        self.update_agent_data(False, False, self.position)
 
     def update(self):
         self.num_agent_updates = self.num_agent_updates + 1
 
+        if len(self.planned) > 0:
+            self.update_planned()
+            return
+
         # Update motion model
         (new_position, new_theta, change, is_colliding, is_colliding_corner) = self.motion_model.update(self.position, self.theta)
 
@@ -243,6 +324,20 @@ class Agent():
 
 
 
+    # The agent stays where it is for n more updates, which add the same
+    # statistics as the last update. Used when an episode is stopped early.
+    def extrapolate(self, n, reason=None):
+        (is_colliding, is_colliding_corner, counted, far, close, avg) = self.last_update_data
+        self.num_agent_updates = self.num_agent_updates + n
+        self.num_of_collisions = self.num_of_collisions + n*is_colliding
+        self.num_of_corner_collisions = self.num_of_corner_collisions + n*is_colliding_corner
+        self.counted_sensors = self.counted_sensors + n*counted
+        self.far_from_wall = self.far_from_wall + n*far
+        self.close_to_wall = self.close_to_wall + n*close
+        self.avg_sensor_distance = self.avg_sensor_distance + n*avg
+        self.skipped_updates = self.skipped_updates + n
+        self.stop_reason = reason
+
     def on_key_press(self, key):
         # React to the key press
         try:
@@ -0,0 +1,57 @@
+import math
+import numpy as np
+
+
+# Differential drive kinematics.
+# In an update the agent either moves straight (vl == vr) or rotates by
+# omega around its ICC (instantaneous center of curvature). The rotation is
+# written out instead of A1.dot(A2) + A3 with a 3x3 rotation matrix, which
+# costs more in NumPy call overhead than the arithmetic itself.
+#
+# The single agent version works on floats, the batch version on arrays of
+# N agents. Both do the same IEEE operations in the same order, so they give
+# bit for bit the same results.
+#
+# l: distance between the wheels
+# step: number of ticks the update covers, see MotionModel
+
+
+def differential_drive(x, y, theta, vl, vr, l, step=1):
+    if vl == vr:
+        v = vr * step
+        return (x + v * math.cos(theta), y + v * math.sin(theta), theta)
+
+    R = (l/2)*((vr + vl)/(vr - vl))
+    omega = ((vr - vl)/l) * step
+
+    ICCx = x - R * math.sin(theta)
+    ICCy = y + R * math.cos(theta)
+    cos = math.cos(omega)
+    sin = math.sin(omega)
+    dx = x - ICCx
+    dy = y - ICCy
+    return (cos*dx - sin*dy + ICCx, sin*dx + cos*dy + ICCy, theta + omega)
+
+
+def differential_drive_batch(x, y, theta, vl, vr, l, step=1):
+    # The ICC of the agents that move straight is at infinity, their
+    # rotation is computed anyway and thrown away
+    with np.errstate(divide="ignore", invalid="ignore"):
+        R = (l/2)*((vr + vl)/(vr - vl))
+        omega = ((vr - vl)/l) * step
+
+        ICCx = x - R*np.sin(theta)
+        ICCy = y + R*np.cos(theta)
+        cos = np.cos(omega)
+        sin = np.sin(omega)
+        dx = x - ICCx
+        dy = y - ICCy
+        rotated_x = cos*dx - sin*dy + ICCx
+        rotated_y = sin*dx + cos*dy + ICCy
+
+    straight = vl == vr
+    v = vr * step
+    new_x = np.where(straight, x + v*np.cos(theta), rotated_x)
+    new_y = np.where(straight, y + v*np.sin(theta), rotated_y)
+    new_theta = np.where(straight, theta, theta + omega)
+    return (new_x, new_y, new_theta)
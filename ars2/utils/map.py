@@ -3,6 +3,9 @@ import os
 
 from utils.object import Object
 from utils.vector import Vector, Point
+from utils.raycast import pack_walls
+from utils.spatial_grid import WallGrid
+from utils.sensor_table import get_table_paths, TABLE_SUFFIX, META_SUFFIX
 
 
 def read_map(map_path, index):
@@ -34,7 +37,7 @@ def read_map(map_path, index):
             MAP["map"].append(
                 Object(p, [
                     Vector(Point(0,0), Point(c2[0]-c1[0], c2[1] - c1[1]))
-                ], type="line")
+                ], type="line", static=True)
             )
 
         c1 = poly[0]
@@ -45,7 +48,7 @@ def read_map(map_path, index):
         MAP["map"].append(
             Object(Point(c1[0], c1[1]), [
                 Vector(Point(0,0), Point(c2[0]-c1[0], c2[1] - c1[1]))
-            ], type="line")
+            ], type="line", static=True)
         )
     
     sp = json.loads(map[len(map) - 1])
@@ -53,13 +56,56 @@ def read_map(map_path, index):
         MAP["start_points"].append(
             Point(p[0],p[1])
         )
+
+    # Spatial index over the walls, shared by the sensors and the collision detection
+    MAP["grid"] = WallGrid(pack_walls(MAP["map"]))
+
+    # Path to the precomputed sensor readings, if they were built for this map
+    (table_path, meta_path) = get_table_paths(map_path)
+    MAP["sensor_table"] = None
+    if os.path.exists(table_path) and os.path.exists(meta_path):
+        MAP["sensor_table"] = table_path
+    return MAP
+
+# Creates a map from packed walls (see utils.raycast.pack_walls), e.g. walls
+# living in shared memory. The walls array is used as is, without copying.
+# The features are the vertices of the walls.
+def create_map(walls, start_points, index, sensor_table=None):
+    MAP = {
+        "map":[],
+        "start_points":[],
+        "index":index,
+        "features":[],
+        "grid":WallGrid(walls),
+        "sensor_table":sensor_table
+    }
+
+    vertices = set()
+    for (x1, y1, x2, y2) in walls.tolist():
+        MAP["map"].append(
+            Object(Point(x1, y1), [
+                Vector(Point(0,0), Point(x2-x1, y2-y1))
+            ], type="line", static=True)
+        )
+        for v in ((x1, y1), (x2, y2)):
+            if v not in vertices:
+                vertices.add(v)
+                MAP["features"].append(Point(v[0], v[1]))
+
+    for p in start_points:
+        MAP["start_points"].append(
+            Point(p[0],p[1])
+        )
     return MAP
 
 def get_maps(path):
     print("Available maps:")
     maps = list()
     i = 0
-    for map_path in os.listdir(path):
+    for map_path in sorted(os.listdir(path)):
+        # Skip the precomputed sensor tables that live next to the maps
+        if map_path.endswith(TABLE_SUFFIX) or map_path.endswith(META_SUFFIX):
+            continue
         p = os.path.abspath(os.path.join(path, map_path))
         print(p)
         maps.append(read_map(p, i))
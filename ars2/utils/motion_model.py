@@ -3,9 +3,10 @@ import numpy as np
 
 from utils.vector import Point, Vector
 from utils.collision_detection import CollisionDetection
+from utils.kinematics import differential_drive
 
 class MotionModel():
-    def __init__(self, l, map, max_speed):
+    def __init__(self, l, map, max_speed, grid=None, step=1, continuous=False):
         # Left and right motor speeds
         self.vl = 0
         self.vr = 0
@@ -20,7 +21,17 @@ class MotionModel():
 
         self.map = map
 
-        self.collision_detection = CollisionDetection(self.l/2)
+        self.collision_detection = CollisionDetection(self.l/2, grid, map)
+
+        # Number of ticks an update covers, the agent moves and turns step
+        # times as far as in a single tick
+        self.step = step
+
+        # Continuous collision detection: the agent is moved along its path
+        # and stopped where it first touches a wall, instead of only being
+        # checked for overlap at the end of the update. Without it, large
+        # steps let the agent jump through walls.
+        self.continuous = continuous
 
         self.is_colliding = False
         self.is_colliding2 = False
@@ -76,34 +87,17 @@ class MotionModel():
         if self.vr == 0 and self.vl == 0:
             return (None, None, False, self.is_colliding, self.is_colliding2)
         
-        if self.vr == self.vl:
-            # We have forward linear motion, theta stays the same, 
-            # we only update the position
-            new_position = Point(position.X + self.vr * math.cos(theta),
-                                     position.Y + self.vr * math.sin(theta))
-            new_theta = theta
-
-        else:
-            # We have a rotation
-            ICCx = position.X - self.R * math.sin(theta)
-            ICCy = position.Y + self.R * math.cos(theta)
-
-            # Now let's calculate the new position of the agent
-            A1 = np.array([[math.cos(self.omega), -math.sin(self.omega), 0],
-                        [math.sin(self.omega), math.cos(self.omega), 0],
-                        [0,0,1]])
-            A2 = np.array([position.X - ICCx, 
-                            position.Y - ICCy,
-                            theta])
-            A3 = np.array([ICCx, ICCy, self.omega])
-
-            P = A1.dot(A2) + A3
-
-            new_position = Point(P[0],P[1])
-            new_theta = P[2]
+        (x, y, new_theta) = differential_drive(position.X, position.Y, theta, self.vl, self.vr, self.l, self.step)
+        new_position = Point(x, y)
 
+        impact = None
+        if self.continuous:
+            (new_position, new_theta, impact) = self.sweep(position, theta, new_position, new_theta)
 
         collisions = self.collision_detection.update(new_position, self.map, (self.vr + self.vl)/2, new_theta)
+        if impact is not None and impact[2] not in [c[2] for c in collisions]:
+            # The agent stopped right at the wall, it touches it
+            collisions = [impact] + collisions
         if len(collisions) == 1:
             self.is_colliding2 = False
             if  self.is_colliding == False:
@@ -141,23 +135,25 @@ class MotionModel():
                 # Calculate intersection between two circles around d1 and d2 with 
                 # the same radius as the agent
 
-                (x3, y3, x4, y4) = self.get_intersections(
+                intersections = self.get_intersections(
                     col_point1.X, col_point1.Y, self.l/2,
                     col_point2.X, col_point2.Y, self.l/2
                 )
 
-                a = np.array([new_position.X, new_position.Y])
-                p1 = np.array([x3, y3])
-                p2 = np.array([x4, y4])
+                if intersections is None:
+                    # The circles don't intersect, stay at the new position
+                    new_theta = theta
+                else:
+                    (x3, y3, x4, y4) = intersections
 
-                d1 = np.linalg.norm(a-p1)
-                d2 = np.linalg.norm(a-p2)
+                    d1 = math.hypot(new_position.X - x3, new_position.Y - y3)
+                    d2 = math.hypot(new_position.X - x4, new_position.Y - y4)
 
-                if d2 < d1:
-                    p1 = p2
+                    if d2 < d1:
+                        (x3, y3) = (x4, y4)
 
-                new_position = Point(p1[0], p1[1])
-                new_theta = theta
+                    new_position = Point(x3, y3)
+                    new_theta = theta
 
 
         else:
@@ -165,12 +161,56 @@ class MotionModel():
             self.is_colliding2 = False
             self.collisions = []
 
+        if self.continuous and len(collisions) > 0:
+            # Snapping back, sliding along a wall or moving between two walls
+            # must not go through another wall either
+            new_position = self.sweep_line(position, new_position)[0]
+
 
         
         # We return the updated position and the theta angle
         return (new_position, new_theta, True, self.is_colliding, self.is_colliding2)
 
 
+    # Continuous collision detection for the motion of an update, from
+    # (position, theta) to (new_position, new_theta). Returns the pose where
+    # the agent first touches a wall and the collision (contact, 0, wall), or
+    # the new pose and None if it doesn't touch any.
+    # An arc is followed as a chain of short chords.
+    def sweep(self, position, theta, new_position, new_theta):
+        omega = new_theta - theta
+        pieces = max(1, math.ceil(abs(omega)/0.1))
+
+        start = position
+        for k in range(1, pieces + 1):
+            if k == pieces:
+                end = new_position
+            else:
+                # Rotate around the ICC by a part of the angle
+                ICCx = position.X - self.R * math.sin(theta)
+                ICCy = position.Y + self.R * math.cos(theta)
+                a = omega*k/pieces
+                end = Point(math.cos(a)*(position.X - ICCx) - math.sin(a)*(position.Y - ICCy) + ICCx,
+                            math.sin(a)*(position.X - ICCx) + math.cos(a)*(position.Y - ICCy) + ICCy)
+
+            (point, t, impact) = self.sweep_line(start, end)
+            if impact is not None:
+                return (point, theta + omega*(k - 1 + t)/pieces, impact)
+            start = end
+
+        return (new_position, new_theta, None)
+
+    # Straight motion from start to end, returns the point where the agent
+    # first touches a wall, the fraction of the motion done until then and
+    # the collision, or (end, 1, None)
+    def sweep_line(self, start, end):
+        toi = self.collision_detection.get_time_of_impact(start.X, start.Y, end.X, end.Y, self.map)
+        if toi is None:
+            return (end, 1, None)
+        (t, contact, wall) = toi
+        point = Point(start.X + t*(end.X - start.X), start.Y + t*(end.Y - start.Y))
+        return (point, t, (contact, 0.0, wall))
+
     def get_intersections(self, x0, y0, r0, x1, y1, r1):
         # circle 1: (x0, y0), radius r0
         # circle 2: (x1, y1), radius r1
@@ -206,7 +246,7 @@ class MotionModel():
         point_of_contact = collision[0]
         wall = collision[2]
 
-        v = (self.vr + self.vl)/2
+        v = self.step*(self.vr + self.vl)/2
 
         # Simulate next position as if there was no wall
         new_position = Point(point_of_contact.X - self.dir*v * math.cos(theta),
@@ -214,19 +254,18 @@ class MotionModel():
 
         # Make the new "supposed" point, project it to the wall
         # Project the trajectory of the agent if there were no wall on the wall vector
-        #to_project = np.array([[point_of_contact.X, point_of_contact.Y], 
-        #                    [new_positionupdate_dir.X, new_position.Y]])
-        to_project = np.array([new_position.X - point_of_contact.X, new_position.Y - point_of_contact.Y])
+        to_x = new_position.X - point_of_contact.X
+        to_y = new_position.Y - point_of_contact.Y
 
         # Points of wall into vector
         wall_1 = wall.get_bounds()[0].P1
         wall_2 = wall.get_bounds()[0].P2
-        #wall_vector = np.array([[wall_1.X, wall_1.Y], [wall_2.X, wall_2.Y]])
-        wall_vector = np.array([wall_2.X - wall_1.X, wall_2.Y - wall_1.Y])
+        wx = wall_2.X - wall_1.X
+        wy = wall_2.Y - wall_1.Y
 
         # Projection formula
-        v_parallel = (np.dot(to_project, wall_vector)/np.dot(wall_vector, wall_vector))*wall_vector
-        return v_parallel
+        p = (to_x*wx + to_y*wy)/(wx*wx + wy*wy)
+        return (p*wx, p*wy)
 
     def is_moving(self):
         if abs(self.vl) > 0 or abs(self.vr) > 0:
@@ -36,12 +36,28 @@ from utils.vector import Point
 from utils.vector import Vector
 
 
+# Static objects (the walls of the maps) don't move, their bounds and ui
+# coordinates in the environment's referential are computed once and the same
+# Vector objects are returned on every call. They are computed again when the
+# object is moved with its methods, but not when the points of its bounds are
+# changed directly.
 class Object():
-    def __init__(self, coordinates, bounds, type):
+    def __init__(self, coordinates, bounds, type, static=False):
         self.coordinates = coordinates  # Point
         self.bounds = bounds            # List[Vector]
         self.type = type                # String type
 
+        self.static = static
+        self.cached_bounds = None
+        self.cached_ui_coordinates = None
+        self.update_cache()
+
+    def update_cache(self):
+        if not self.static:
+            return
+        self.cached_bounds = self.translate_bounds()
+        self.cached_ui_coordinates = self.create_ui_coordinates()
+
     # Get object's coordinates origin in a 2D space
     def get_coordinates(self):
         return self.coordinates
@@ -52,10 +68,12 @@ class Object():
     # POV FP
     def translate_coordinates(self, point):
         self.coordinates = Point(self.coordinates.X + point.X, self.coordinates.Y + point.Y)
+        self.update_cache()
 
     # Set the center of the object to the provided point
     def update_coordinates(self,point):
         self.coordinates = point
+        self.update_cache()
 
     def rotate_bounds(self, theta):
         for b in self.bounds:
@@ -64,6 +82,7 @@ class Object():
 
             b.P2.X = b.P2.X * math.cos(theta)
             b.P2.Y = b.P2.Y * math.sin(theta)
+        self.update_cache()
 
     # Function to rotate an object by an angle, having its center as pivot
     # POV FP
@@ -83,10 +102,16 @@ class Object():
                 y2 = bounds.P2.X * math.sin(angle) + bounds.P2.Y * math.cos(angle)
                 new_bounds.append(Vector(Point(x1,y1), Point(x2,y2)))
         self.bounds = new_bounds
+        self.update_cache()
 
     # Return the translated bounds in the environment's referential
     # POV ENV
     def get_bounds(self):
+        if self.static:
+            return self.cached_bounds
+        return self.translate_bounds()
+
+    def translate_bounds(self):
         translated_bounds = []
         for bound in self.bounds:
             #bound.print()
@@ -102,6 +127,11 @@ class Object():
 
     # For the UI, we need to return proper coordinates to have them handled
     def get_ui_coordinates(self):
+        if self.static:
+            return self.cached_ui_coordinates
+        return self.create_ui_coordinates()
+
+    def create_ui_coordinates(self):
 
         # For circle type we need to get the upper left corner of the box surrounding the circle
         if self.type == "circle":
@@ -0,0 +1,53 @@
+import numpy as np
+
+
+# Packs a list of line objects (walls of a map) into a (N, 4) array
+# where every row is (x1, y1, x2, y2) in the environment's referential.
+# This is the representation the vectorized raycasting works on.
+def pack_walls(walls):
+    packed = np.empty((len(walls), 4))
+    for i in range(len(walls)):
+        c = walls[i].get_ui_coordinates()
+        packed[i] = (c.P1.X, c.P1.Y, c.P2.X, c.P2.Y)
+    return packed
+
+
+# Intersects every ray segment (starts[i] -> ends[i]) with every wall and
+# returns the distance from the start of the ray to the nearest hit.
+# Rays that don't hit anything get np.inf.
+#
+# starts, ends: (R, 2) arrays
+# walls: (N, 4) array shared by all rays, or (R, N, 4) if every ray has its own
+#        set of walls (rows padded with NaN are ignored)
+def cast_rays(starts, ends, walls):
+    starts = np.asarray(starts, dtype=float)
+    ends = np.asarray(ends, dtype=float)
+    if walls.shape[-2] == 0:
+        return np.full(len(starts), np.inf)
+
+    # Ray direction r and wall direction s
+    rx = (ends[:, 0] - starts[:, 0])[:, None]
+    ry = (ends[:, 1] - starts[:, 1])[:, None]
+    ax = starts[:, 0][:, None]
+    ay = starts[:, 1][:, None]
+
+    cx = walls[..., 0]
+    cy = walls[..., 1]
+    sx = walls[..., 2] - cx
+    sy = walls[..., 3] - cy
+
+    # Solve A + t*r = C + u*s for t (along the ray) and u (along the wall)
+    denom = rx * sy - ry * sx
+    qx = cx - ax
+    qy = cy - ay
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (qx * sy - qy * sx) / denom
+        u = (qx * ry - qy * rx) / denom
+
+    # Parallel lines (denom == 0) give inf/nan and are filtered out here
+    hit = (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    t = np.where(hit, t, np.inf)
+    t_min = t.min(axis=1)
+
+    length = np.hypot(rx[:, 0], ry[:, 0])
+    return t_min * length
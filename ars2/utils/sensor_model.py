@@ -1,16 +1,34 @@
 import math
+import sys
 import numpy as np
 
 from utils.motion_model import MotionModel
 from utils.object import Object
 from utils.vector import Vector, Point
 
+from utils.raycast import pack_walls, cast_rays
+
 from shapely.geometry import LineString
 
 
+# Angles of the sensors relative to the heading of the agent
+def get_sensor_angles(num_sensors):
+    angle = 360/num_sensors
+
+    angles = []
+    i = math.radians(0)
+    while i < math.pi * 2:
+        angles.append(i)
+        i = i + math.radians(angle)
+    return angles
+
 
 class SensorModel():
-    def __init__(self, position, theta, radius, map, num_sensors=12, max_vision=100):
+    # raycast can be "numpy" (vectorized over all sensors and walls),
+    # "shapely" (one LineString intersection per sensor and wall) or
+    # "table" (interpolated from a precomputed utils.sensor_table.SensorTable)
+    def __init__(self, position, theta, radius, map, num_sensors=12, max_vision=100,
+                    raycast="numpy", grid=None, table=None):
         self.position  = position
         self.theta = theta
         self.radius = radius
@@ -19,17 +37,43 @@ class SensorModel():
         self.num_sensors = num_sensors
         self.max_vision = max_vision
 
+        self.raycast = raycast
+
+        # Optional utils.spatial_grid.WallGrid, rays then only check the
+        # walls in the cells they cross
+        self.grid = grid
+
+        if self.raycast not in ("numpy", "shapely", "table"):
+            print("Unknown raycast backend: " + str(self.raycast))
+            sys.exit()
+
+        self.table = table
+        if self.raycast == "table" and self.table is None:
+            print("No sensor table for the table raycast backend!")
+            sys.exit()
+        if self.table is not None and self.table.max_range < self.max_vision + self.radius:
+            print("Sensor table range is shorter than the sensors!")
+            sys.exit()
+
         self.sensors = []
         self.distances = []
+        self.angles = []
+
+        # Lengths of the sensor lines, only used by the numpy and table
+        # backends to create the sensor lines lazily for drawing
+        self.lengths = None
 
         self.init_sensors()
 
-    def init_sensors(self):
-        angle = 360/self.num_sensors
+        if self.raycast != "shapely":
+            if self.grid is not None:
+                self.walls = self.grid.walls
+            else:
+                self.walls = pack_walls(self.map)
+            self.angles = np.array(self.angles)
 
-        j = 0
-        i = math.radians(0)
-        while i < math.pi * 2:
+    def init_sensors(self):
+        for i in get_sensor_angles(self.num_sensors):
             # Calculate the line for every angle and append it to sensors
             P1 = Point(self.radius * math.cos(i), self.radius*math.sin(i))
             P2 = Point(self.max_vision * math.cos(i), self.max_vision*math.sin(i))
@@ -40,11 +84,14 @@ class SensorModel():
             self.distances.append(-1)
                 
             self.sensors.append(l)
-            i = i + math.radians(angle)
-            j = j + 1
+            self.angles.append(i)
         
 
     def get_sensor_lines(self):
+        if self.lengths is not None:
+            self.sensors = self.create_sensor_lines()
+            self.lengths = None
+
         coords = []
         for s in self.sensors:
             coords.append(s.get_ui_coordinates())
@@ -59,6 +106,13 @@ class SensorModel():
 
 
     def update(self, new_position, new_theta):
+        if self.raycast == "numpy":
+            self.update_numpy(new_position, new_theta)
+            return
+        if self.raycast == "table":
+            self.update_table(new_position, new_theta)
+            return
+
         self.sensors = []
         angle = 360/self.num_sensors
 
@@ -97,6 +151,106 @@ class SensorModel():
         self.position = new_position
         self.theta = new_theta
 
+    def update_numpy(self, new_position, new_theta):
+        # Same sensor lines as in update, but all of them are intersected
+        # with all the walls of the map in one call
+        a = self.angles + new_theta
+        cos = np.cos(a)
+        sin = np.sin(a)
+
+        starts = np.empty((self.num_sensors, 2))
+        starts[:, 0] = new_position.X + self.radius * cos
+        starts[:, 1] = new_position.Y + self.radius * sin
+
+        ends = np.empty((self.num_sensors, 2))
+        ends[:, 0] = new_position.X + (self.max_vision + self.radius) * cos
+        ends[:, 1] = new_position.Y + (self.max_vision + self.radius) * sin
+
+        walls = self.walls
+        if self.grid is not None:
+            walls = walls[self.grid.query_segments(starts, ends)]
+
+        d = cast_rays(starts, ends, walls)
+        hit = np.isfinite(d)
+
+        self.distances = [round(v, 1) if h else -1000 for (v, h) in zip(d.tolist(), hit.tolist())]
+        self.lengths = self.radius + np.where(hit, d, self.max_vision)
+
+        self.position = new_position
+        self.theta = new_theta
+
+    def update_table(self, new_position, new_theta):
+        # The table holds the distance from the center of the agent to the
+        # nearest wall, the sensor itself starts at the radius. Walls closer
+        # than the radius (only when the agent overlaps a wall) hide the walls
+        # behind them, unlike in the raycasting backends.
+        d = self.table.lookup(new_position.X, new_position.Y, self.angles + new_theta)
+        d = d.astype(float) - self.radius
+        hit = (d >= 0) & (d <= self.max_vision)
+
+        self.distances = [round(v, 1) if h else -1000 for (v, h) in zip(d.tolist(), hit.tolist())]
+        self.lengths = self.radius + np.where(hit, d, self.max_vision)
+
+        self.position = new_position
+        self.theta = new_theta
+
+    # Readings of the sensors at several poses (x, y, theta), as a list of
+    # (distances, lengths), the same as update_numpy and update_table give.
+    # The numpy backend casts the rays of all the poses in one call.
+    def get_readings(self, poses):
+        if self.raycast == "table":
+            readings = []
+            for (x, y, theta) in poses:
+                d = self.table.lookup(x, y, self.angles + theta)
+                d = d.astype(float) - self.radius
+                hit = (d >= 0) & (d <= self.max_vision)
+                distances = [round(v, 1) if h else -1000 for (v, h) in zip(d.tolist(), hit.tolist())]
+                readings.append((distances, self.radius + np.where(hit, d, self.max_vision)))
+            return readings
+
+        poses = np.array(poses)
+        a = self.angles[None, :] + poses[:, 2, None]
+        cos = np.cos(a).ravel()
+        sin = np.sin(a).ravel()
+        x = np.repeat(poses[:, 0], self.num_sensors)
+        y = np.repeat(poses[:, 1], self.num_sensors)
+
+        starts = np.empty((len(x), 2))
+        starts[:, 0] = x + self.radius * cos
+        starts[:, 1] = y + self.radius * sin
+
+        ends = np.empty((len(x), 2))
+        ends[:, 0] = x + (self.max_vision + self.radius) * cos
+        ends[:, 1] = y + (self.max_vision + self.radius) * sin
+
+        walls = self.walls
+        if self.grid is not None:
+            walls = walls[self.grid.query_segments(starts, ends)]
+
+        d = cast_rays(starts, ends, walls).reshape(len(poses), self.num_sensors)
+        hit = np.isfinite(d)
+
+        readings = []
+        for k in range(len(poses)):
+            distances = [round(v, 1) if h else -1000 for (v, h) in zip(d[k].tolist(), hit[k].tolist())]
+            readings.append((distances, self.radius + np.where(hit[k], d[k], self.max_vision)))
+        return readings
+
+    # Sets the pose and the readings of the sensors, which were read before
+    # with get_readings
+    def set_readings(self, new_position, new_theta, reading):
+        (self.distances, self.lengths) = reading
+        self.position = new_position
+        self.theta = new_theta
+
+    def create_sensor_lines(self):
+        sensors = []
+        for j in range(self.num_sensors):
+            a = self.angles[j] + self.theta
+            P1 = Point(self.radius * math.cos(a), self.radius*math.sin(a))
+            P2 = Point(self.lengths[j] * math.cos(a), self.lengths[j] * math.sin(a))
+            sensors.append(Object(self.position, [Vector(P1, P2)], type="line"))
+        return sensors
 
 
     def calculate_sensor_collision(self, sensor_line):
@@ -111,7 +265,12 @@ class SensorModel():
         wall = None
         point = None
 
-        for m in self.map:
+        walls = self.map
+        if self.grid is not None:
+            indices = self.grid.query_segments([(A.X, A.Y)], [(B.X, B.Y)])
+            walls = [self.map[i] for i in indices]
+
+        for m in walls:
             coords = m.get_ui_coordinates()
             C = coords.P1
             D = coords.P2
@@ -0,0 +1,178 @@
+import argparse
+import json
+import math
+import os
+import time
+import numpy as np
+
+from utils.raycast import cast_rays
+
+
+# Precomputed sensor readings for a map.
+# The map is discretized into (x, y, angle) and for every cell we store the
+# distance from (x, y) to the nearest wall along the ray with that angle.
+# A sensor reading is then a (trilinear) interpolation in the table instead of
+# a raycast. Since the ray starts in the center of the agent, the radius and
+# max vision of the agent are applied when reading from the table, so one
+# table serves all agents on that map.
+#
+# The table is saved as a .npy file next to the map so it can be memory mapped
+# read-only, the parameters of the discretization are saved in a .json file.
+
+TABLE_SUFFIX = ".sensors.npy"
+META_SUFFIX = ".sensors.json"
+
+# Tables that were already loaded in this process, by path
+loaded_tables = {}
+
+
+def get_table_paths(map_path):
+    return (map_path + TABLE_SUFFIX, map_path + META_SUFFIX)
+
+
+class SensorTable():
+    def __init__(self, table, origin_x, origin_y, resolution, max_range):
+        # (nx, ny, n_angles), a memmap is viewed as a plain array since
+        # indexing np.memmap is a lot slower, the data stays memory mapped
+        self.table = table.view(np.ndarray)
+        self.origin_x = origin_x
+        self.origin_y = origin_y
+        self.resolution = resolution
+        self.max_range = max_range
+
+        (self.nx, self.ny, self.n_angles) = self.table.shape
+        self.angle_step = 2 * math.pi / self.n_angles
+
+    # Distance from (x, y) to the nearest wall along each of the angles.
+    # Returns max_range where nothing is hit.
+    def lookup(self, x, y, angles):
+        fx = (x - self.origin_x) / self.resolution
+        fy = (y - self.origin_y) / self.resolution
+        ix = min(max(int(math.floor(fx)), 0), self.nx - 2)
+        iy = min(max(int(math.floor(fy)), 0), self.ny - 2)
+        wx = min(max(fx - ix, 0.0), 1.0)
+        wy = min(max(fy - iy, 0.0), 1.0)
+
+        fa = np.mod(angles, 2 * math.pi) / self.angle_step
+        ia = fa.astype(np.int64)
+        wa = fa - ia
+        ia = np.concatenate((ia, ia + 1)) % self.n_angles
+
+        # Bilinear weights of the 2x2 block of cells around the position
+        w = np.array([[(1 - wx) * (1 - wy), (1 - wx) * wy],
+                        [wx * (1 - wy), wx * wy]])
+
+        block = self.table[ix:ix + 2, iy:iy + 2, ia]
+        c = np.tensordot(w, block, 2)
+
+        # Linear in the angle
+        n = len(wa)
+        return c[:n] + (c[n:] - c[:n]) * wa
+
+
+def build_sensor_table(walls, resolution=8, n_angles=360, max_range=550, dtype=np.float16, path=None):
+    t = time.time()
+
+    origin_x = min(walls[:, 0].min(), walls[:, 2].min())
+    origin_y = min(walls[:, 1].min(), walls[:, 3].min())
+    max_x = max(walls[:, 0].max(), walls[:, 2].max())
+    max_y = max(walls[:, 1].max(), walls[:, 3].max())
+
+    nx = int(math.ceil((max_x - origin_x) / resolution)) + 1
+    ny = int(math.ceil((max_y - origin_y) / resolution)) + 1
+
+    if path is not None:
+        table = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(nx, ny, n_angles))
+    else:
+        table = np.empty((nx, ny, n_angles), dtype=dtype)
+
+    angles = np.arange(n_angles) * (2 * math.pi / n_angles)
+    directions = np.stack((np.cos(angles), np.sin(angles)), axis=1)
+
+    # One row of x at a time, all the y positions and angles of the row are
+    # cast in chunks so that the (rays, walls) arrays stay small
+    ys = origin_y + np.arange(ny) * resolution
+    chunk = max(1, 4000000 // max(len(walls), 1))
+    for ix in range(nx):
+        x = origin_x + ix * resolution
+        starts = np.repeat(np.stack((np.full(ny, x), ys), axis=1), n_angles, axis=0)
+        ends = starts + np.tile(directions, (ny, 1)) * max_range
+
+        d = np.empty(len(starts))
+        for i in range(0, len(starts), chunk):
+            d[i:i + chunk] = cast_rays(starts[i:i + chunk], ends[i:i + chunk], walls)
+        d = np.minimum(d, max_range)
+        table[ix] = d.reshape(ny, n_angles)
+
+    if path is not None:
+        table.flush()
+
+    print("Sensor table " + str(table.shape) + " built in " + str(round(time.time() - t, 2)) + " s, "
+            + str(round(table.nbytes / 1024**2, 2)) + " MB")
+
+    return SensorTable(table, origin_x, origin_y, resolution, max_range)
+
+
+def save_sensor_table_meta(meta_path, table):
+    data = {
+        "origin_x": float(table.origin_x),
+        "origin_y": float(table.origin_y),
+        "resolution": table.resolution,
+        "max_range": table.max_range,
+        "shape": list(table.table.shape),
+        "dtype": str(table.table.dtype)
+    }
+    with open(meta_path, 'w') as outfile:
+        json.dump(data, outfile, indent=4)
+
+
+def create_sensor_table(map, map_path, resolution=8, n_angles=360, max_range=550, dtype=np.float16):
+    (table_path, meta_path) = get_table_paths(map_path)
+    table = build_sensor_table(map["grid"].walls, resolution, n_angles, max_range, dtype, table_path)
+    save_sensor_table_meta(meta_path, table)
+    return table
+
+
+# Loads the table memory mapped and read-only. Every process loads a table
+# only once, the pages are shared between processes by the OS.
+def load_sensor_table(table_path):
+    if table_path in loaded_tables:
+        return loaded_tables[table_path]
+
+    meta_path = table_path[:-len(TABLE_SUFFIX)] + META_SUFFIX
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+
+    table = np.load(table_path, mmap_mode="r")
+    sensor_table = SensorTable(table, meta["origin_x"], meta["origin_y"],
+                                meta["resolution"], meta["max_range"])
+    loaded_tables[table_path] = sensor_table
+    return sensor_table
+
+
+def main():
+    # Imported here, utils.map itself needs to know about the table files
+    from utils.map import read_map
+
+    parser = argparse.ArgumentParser(description='Precompute the sensor readings of maps.')
+    parser.add_argument('maps', nargs='+',
+                        help='Paths to the maps.')
+    parser.add_argument('--resolution', action='store', default=8, type=float,
+                        help='Size of a position cell in px. Default is 8.')
+    parser.add_argument('--angles', action='store', default=360, type=int,
+                        help='Number of discretized angles. Default is 360.')
+    parser.add_argument('--max_range', action='store', default=550, type=float,
+                        help='Longest distance stored, should be at least max vision + radius. Default is 550.')
+    parser.add_argument('--float32', action=argparse.BooleanOptionalAction, default=False,
+                        help='Store the table as float32 instead of float16.')
+    args = parser.parse_args()
+
+    dtype = np.float32 if args.float32 else np.float16
+    for map_path in args.maps:
+        print(os.path.abspath(map_path))
+        map = read_map(map_path, 0)
+        create_sensor_table(map, map_path, args.resolution, args.angles, args.max_range, dtype)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+import math
+import numpy as np
+
+
+# Uniform grid over the walls of a map.
+# Every wall is put into all the cells its bounding box overlaps, so a query
+# only has to look at the walls of the cells it touches instead of the whole map.
+# The cells are stored in CSR form: the walls of cell c are
+# items[start[c]:start[c+1]], where c = ix*ny + iy, and as a padded table
+# for the vectorized queries.
+class WallGrid():
+    # For maps with only a few walls, intersecting a ray with all of them is
+    # cheaper than walking the cells, so rays only walk the grid above this
+    ray_walk_min_walls = 512
+
+    def __init__(self, walls, cell_size=64):
+        self.walls = walls  # (N, 4) packed walls, see utils.raycast.pack_walls
+        self.cell_size = cell_size
+        self.all_walls = np.arange(len(walls))
+
+        if len(walls) == 0:
+            self.origin_x = 0
+            self.origin_y = 0
+        else:
+            self.origin_x = min(walls[:, 0].min(), walls[:, 2].min())
+            self.origin_y = min(walls[:, 1].min(), walls[:, 3].min())
+
+        if len(walls) == 0:
+            self.nx = 1
+            self.ny = 1
+        else:
+            max_x = max(walls[:, 0].max(), walls[:, 2].max())
+            max_y = max(walls[:, 1].max(), walls[:, 3].max())
+            self.nx = int((max_x - self.origin_x) // cell_size) + 1
+            self.ny = int((max_y - self.origin_y) // cell_size) + 1
+
+        self.build()
+
+    def build(self):
+        cells = [[] for i in range(self.nx * self.ny)]
+
+        for i in range(len(self.walls)):
+            (x1, y1, x2, y2) = self.walls[i]
+            (ix1, iy1) = self.get_cell(min(x1, x2), min(y1, y2))
+            (ix2, iy2) = self.get_cell(max(x1, x2), max(y1, y2))
+            for ix in range(ix1, ix2 + 1):
+                for iy in range(iy1, iy2 + 1):
+                    cells[ix * self.ny + iy].append(i)
+
+        self.start = np.zeros(len(cells) + 1, dtype=np.int64)
+        self.start[1:] = np.cumsum([len(c) for c in cells])
+        self.items = np.array([i for c in cells for i in c], dtype=np.int64)
+
+        # Same cells padded to a (num_cells, max_walls_per_cell) table, padded
+        # with the index len(walls) which points to a dummy slot in the mask
+        width = max([len(c) for c in cells] + [1])
+        self.table = np.full((len(cells), width), len(self.walls), dtype=np.int64)
+        for i in range(len(cells)):
+            self.table[i, :len(cells[i])] = cells[i]
+
+    def get_cell(self, x, y):
+        ix = int((x - self.origin_x) // self.cell_size)
+        iy = int((y - self.origin_y) // self.cell_size)
+        ix = min(max(ix, 0), self.nx - 1)
+        iy = min(max(iy, 0), self.ny - 1)
+        return (ix, iy)
+
+    def get_walls_in_cells(self, cells):
+        mask = np.zeros(len(self.walls) + 1, dtype=bool)
+        mask[self.table[cells]] = True
+        # Sorted, so the walls are visited in the same order as in the map
+        return np.flatnonzero(mask[:-1])
+
+    # Indices of the walls that can be within distance r of the point (x, y)
+    def query_circle(self, x, y, r):
+        ix1 = math.floor((x - r - self.origin_x) / self.cell_size)
+        iy1 = math.floor((y - r - self.origin_y) / self.cell_size)
+        ix2 = math.floor((x + r - self.origin_x) / self.cell_size)
+        iy2 = math.floor((y + r - self.origin_y) / self.cell_size)
+
+        ix1 = max(ix1, 0)
+        iy1 = max(iy1, 0)
+        ix2 = min(ix2, self.nx - 1)
+        iy2 = min(iy2, self.ny - 1)
+
+        cells = []
+        for ix in range(ix1, ix2 + 1):
+            for iy in range(iy1, iy2 + 1):
+                cells.append(ix * self.ny + iy)
+        return self.get_walls_in_cells(np.array(cells, dtype=np.int64))
+
+    # Ids of all the cells crossed by the segments starts[i] -> ends[i]
+    def cells_on_segments(self, starts, ends):
+        starts = np.asarray(starts, dtype=float)
+        ends = np.asarray(ends, dtype=float)
+        c = self.cell_size
+
+        x0 = starts[:, 0][:, None]
+        y0 = starts[:, 1][:, None]
+        dx = ends[:, 0][:, None] - x0
+        dy = ends[:, 1][:, None] - y0
+
+        # Parameters t in (0, 1) at which the segments cross the grid lines
+        length = np.abs(np.concatenate((dx, dy))).max()
+        k = np.arange(int(length // c) + 2)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            kx = np.floor((np.minimum(x0, x0 + dx) - self.origin_x) / c) + 1 + k
+            tx = (self.origin_x + kx * c - x0) / dx
+            ky = np.floor((np.minimum(y0, y0 + dy) - self.origin_y) / c) + 1 + k
+            ty = (self.origin_y + ky * c - y0) / dy
+            # Cell row/column in which the crossing happens
+            iy_at_x = np.floor((y0 + tx * dy - self.origin_y) / c)
+            ix_at_y = np.floor((x0 + ty * dx - self.origin_x) / c)
+        vx = (tx > 0) & (tx < 1)
+        vy = (ty > 0) & (ty < 1)
+        kx = kx[vx]
+        ky = ky[vy]
+        iy_at_x = iy_at_x[vx]
+        ix_at_y = ix_at_y[vy]
+
+        # Crossing a vertical grid line at kx moves the segment from cell
+        # kx-1 into cell kx (and vice versa), the same for horizontal lines
+
+        ix = np.concatenate((
+            np.floor((starts[:, 0] - self.origin_x) / c),
+            np.floor((ends[:, 0] - self.origin_x) / c),
+            kx - 1, kx, ix_at_y, ix_at_y
+        ))
+        iy = np.concatenate((
+            np.floor((starts[:, 1] - self.origin_y) / c),
+            np.floor((ends[:, 1] - self.origin_y) / c),
+            iy_at_x, iy_at_x, ky - 1, ky
+        ))
+
+        valid = (ix >= 0) & (ix < self.nx) & (iy >= 0) & (iy < self.ny)
+        return (ix * self.ny + iy)[valid].astype(np.int64)
+
+    # Indices of the walls in the cells crossed by the segments
+    def query_segments(self, starts, ends):
+        if len(self.walls) < self.ray_walk_min_walls:
+            return self.all_walls
+        return self.get_walls_in_cells(self.cells_on_segments(starts, ends))
@@ -5,6 +5,9 @@ import math
 import numpy as np
 
 class Point():
+    # Lots of points are created, without a __dict__ they are smaller and faster
+    __slots__ = ("X", "Y")
+
     def __init__(self, X, Y):
         self.X = X
         self.Y = Y
@@ -25,6 +28,8 @@ class Point():
 # We can also compute distances etc here
 # Vector's direction starts from P1 and goes to P2
 class Vector():
+    __slots__ = ("P1", "P2")
+
     def __init__(self, P1, P2):
         self.P1 = P1
         self.P2 = P2